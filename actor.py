@@ -1,9 +1,10 @@
 import random
 import math
 from structs import *
-from entity import Entity
+from entity import Entity, Component, AWARENESS_DECODE, AWARENESS_CODES
 from tile import TileFeature
 import dice
+import combat
 import util
 
 default_actor_attributes = {
@@ -23,7 +24,7 @@ default_actor_attributes = {
 			"skill": "brawling",
 			"quality": 0,
 			"muscle": "thrust",
-			"damage_type": "bash",
+			"damage_type": DamageType.BASH,
 			"damage_mod": -2,
 			"ST_requirement": -1,
 			"reach": [0, 1],
@@ -40,8 +41,21 @@ default_actor_attributes = {
 
 class Actor(Entity):
 	DEFAULT_TEMPLATE = default_actor_attributes
+	# How far the goal of a cached path may wander before it's replanned
+	PATH_TOLERANCE = 2
+	# How many steps ahead a blocked path is patched around
+	REPAIR_HORIZON = 6
+	# Totals across every actor of how cached paths were used
+	path_metrics = {"reused": 0, "extended": 0, "repaired": 0, "replanned": 0}
+	__slots__ = (
+		"_awareness", "aim_target", "aim_turns", "skills", "_goals", "hostiles",
+		"known_locations", "_path", "path_goal", "path_version", "replans",
+		"current_FOV", "discovered", "_equipment", "_base_speed")
+
+	awareness = Component(decode = AWARENESS_DECODE.__getitem__, encode = AWARENESS_CODES.__getitem__)
 
 	def __init__(self, name, position, is_player = False):
+		self._base_speed = None
 		super().__init__(name, position, is_player)
 		self.awareness = Awareness.ALERT
 		self.aim_target = None
@@ -53,21 +67,33 @@ class Actor(Entity):
 		self._goals.append((GoalType.SURVIVE,))
 		self.hostiles = set()
 		self.known_locations = {}
+		# Cached path, stored backwards so the next step is at the end
+		self._path = []
+		self.path_goal = None
+		self.path_version = None
+		self.replans = 0
+		# (body version, held entities, melee template, ranged template)
+		self._equipment = None
+
+	def invalidate_stats(self):
+		super().invalidate_stats()
+		self._base_speed = None
 
 	@property
 	def speed(self):
-		s = (self.DX + self.HT) / 4 + self.traits.get("speed_boost", 0)
+		if (s := self._base_speed) is None:
+			s = self._base_speed = (self.DX + self.HT) / 4 + self.traits.get("speed_boost", 0)
 		if self.hp < self.hp_max / 3: s //= 2
 		return s
 
 	def update(self):
 		if self.dead or self.awareness == Awareness.UNCONSCIOUS:
-			self.delay += 1000
+			self.suspend()
 			return
 		if self.hp <= 0:
 			if dice.roll() > self.HT:
 				self.awareness = Awareness.UNCONSCIOUS
-				self.delay += 1000
+				self.suspend()
 				self.display_tile.bg = (0, 255, 255)
 				self.raise_event(Event(visual = f"[c]The {self.name} faints!"))
 				return
@@ -82,11 +108,11 @@ class Actor(Entity):
 			# -Otherwise, finish off the stragglers (everyone is quite ruthless right now)
 			# -Otherwise, mill around
 			case GoalType.SURVIVE,:
-				seen = set(self.search_for_entities())
-				for e in seen:
-					if not self.factions & e.factions:
-						self.hostiles.add(e)
-				visible_hostiles = list(filter(lambda x: not x.dead, seen & self.hostiles))
+				seen = self.perceived_entities()
+				mask = self.faction_mask
+				hostiles = self.hostiles
+				hostiles.update([e for e in seen if not mask & e.faction_mask])
+				visible_hostiles = [e for e in seen if e in hostiles and not e.dead]
 				visible_hostiles.sort(key = lambda x: util.true_distance(x.position, self.position))
 				if not visible_hostiles:
 					if random.randint(1, 5) != 1:
@@ -141,7 +167,7 @@ class Actor(Entity):
 	def process_event(self, event):
 		# Actors magically know if a sound was created by an enemy
 		# TODO: Figure out how to encode decision making info on sounds
-		if event.emitter is not None and (event.emitter.factions & self.factions):
+		if event.emitter is not None and not event.emitter.is_hostile_to(self):
 			return
 		dist_steps = math.log2(max(util.true_distance(self.position, event.position), 0.5))
 		modifier = math.trunc(event.volume - dist_steps)
@@ -188,52 +214,70 @@ class Actor(Entity):
 		self._goals += result
 		return self.think()
 
+	# What's held and the attack templates that follow from it, only worked out
+	# again once something is picked up or let go of or a limb comes off
+	def equipment(self):
+		if (equipment := self._equipment) is None or equipment[0] != self.body.version:
+			held = []
+			for hand in self.root_part.get_parts_with_trait(PartFlag.GRASPER):
+				if hand.held:
+					held.append([hand, hand.held])
+			weapon = held[0][1] if held else None
+
+			melee = self.melee_attacks[0]
+			if weapon and weapon.melee_attacks:
+				melee = weapon.melee_attacks[0]
+			ranged = None
+			if self.ranged_attacks:
+				ranged = self.ranged_attacks[0]
+			elif weapon and weapon.ranged_attacks:
+				ranged = weapon.ranged_attacks[0]
+			equipment = self._equipment = (self.body.version, held, melee, ranged)
+		return equipment
+
+	# Shared with the equipment cache, don't modify
 	def get_held_entities(self):
-		result = []
-		hands = self.root_part.get_parts_with_trait(PartFlag.GRASPER)
-		for hand in hands:
-			if hand.held:
-				result.append([hand, hand.held])
-		return result
+		return self.equipment()[1]
 
 	def get_weapon(self):
-		held = self.get_held_entities()
+		held = self.equipment()[1]
 		if not held: return None
 		return held[0][1]
 
+	# Entities lying on the map in view, nearest first. Only looks up the cells
+	# this actor can see rather than checking every entity
 	def search_for_entities(self):
-		local_entities = self.observer.contents
-		visible_entities = list(filter(
-			lambda x: self.observer.tiles.visibility_between(self.position, x.global_position) > 0 and x.position is not None,
-			local_entities))
-		visible_entities.sort(key = lambda x: util.manhattan_dist(self.position, x.global_position))
+		visible = self.observer.tiles.visible_from(self.position)
+		visible_entities = self.observer.index.at_positions(visible)
+		visible_entities.sort(key = lambda x: util.manhattan_dist(self.position, x.position))
 		return visible_entities
 
+	# Only actors about to look around for threats need to know what they see
+	def perceives(self):
+		return not self.dead and self.awareness != Awareness.UNCONSCIOUS and \
+			bool(self._goals) and self._goals[-1] == (GoalType.SURVIVE,)
+
+	# What the actor saw at the start of the tick, or a fresh look if it wasn't
+	# due then
+	def perceived_entities(self):
+		seen = self.observer.perception.get(self)
+		if seen is None:
+			seen = self.search_for_entities()
+		return seen
+
 	def get_melee_attack_template(self):
-		weapon = self.get_weapon()
-		if weapon and weapon.melee_attacks:
-			return weapon.melee_attacks[0]
-		return self.melee_attacks[0]
+		return self.equipment()[2]
 
 	def get_ranged_attack_template(self):
-		if self.ranged_attacks:
-			return self.ranged_attacks[0]
-		weapon = self.get_weapon()
-		if weapon and weapon.ranged_attacks:
-			return weapon.ranged_attacks[0]
-		return None
+		return self.equipment()[3]
 
 	def send_attack(self, target, target_part = None):
 		# TODO: This should be passed into the function
 		attack_template = self.get_melee_attack_template()
 		acc = dice.roll()
-		swing = attack_template["muscle"] == "swing"
-		effective_ST = self.ST + max(2, self.ST - 7) if swing else self.ST
-		damage_dice = max((effective_ST - 3) // 8, 1)
-		damage_mod = (effective_ST - 3) % 8 // 2 - 1 if effective_ST >= 11 else (effective_ST + 1) // 2 - 7
-		power = dice.roll(damage_dice, mod = damage_mod)
+		damage_dice, damage_mod = dice.damage_dice(self.ST, attack_template["muscle"] == "swing")
 		damage_type = attack_template["damage_type"]
-		attack = Attack(power, damage_type, target = target_part)
+		attack = Attack(None, damage_type, target = target_part, damage_dice = damage_dice, damage_mod = damage_mod)
 		target.receive_attack(self, attack)
 		self.delay = 10
 
@@ -259,9 +303,9 @@ class Actor(Entity):
 		if (margin := (effective_skill - roll)) < 0:
 			return # TODO: Accidental targets / collateral damage
 		shots = 1 + (margin // attack_template['recoil'])
+		# Every shot in the volley hits as hard, they're all resolved together
 		attack = Attack.from_template(attack_template, target_part)
-		for i in range(shots):
-			target.receive_attack(self, attack)
+		combat.resolve([(self, target, attack)] * shots)
 		self.delay += 10
 
 	def step_from(self, target):
@@ -270,21 +314,17 @@ class Actor(Entity):
 		if 0 <= self.cost_to(direction) <= 10:
 			self.apply_delta(direction)
 
-	def receive_attack(self, attacker, attack):
-		if self.dodge(attacker):
-			attack_descriptor = f"{attacker.name} attacks the {self.name}, but {self.pronoun} dodges!"
-			self.raise_event(Event(visual = attack_descriptor))
-			return
-		if super().receive_attack(attacker, attack) > 0:
-			current_tile = self.observer.tiles.get_tile(*self.position)
-			current_tile.add_feature(
-				TileFeature(
-					name = 'Bloodstain',
-					z_index = 0,
-					fg_overwrite = True,
-					char_overwrite = True,
-					symbol = Glyph('~', (255, 0, 0))))
+	def bleed(self):
+		current_tile = self.observer.tiles.get_tile(*self.position)
+		current_tile.add_feature(
+			TileFeature(
+				name = 'Bloodstain',
+				z_index = 0,
+				fg_overwrite = True,
+				char_overwrite = True,
+				symbol = Glyph('~', (255, 0, 0))))
 
+	def check_death(self):
 		if self.dead: return
 
 		while self.hp <= self.hp_max * self.death_checks * -1:
@@ -304,12 +344,10 @@ class Actor(Entity):
 			self.aim_turns += 1
 		self.delay += 10
 
-	def dodge(self, attacker):
+	def dodge_target(self, attacker):
 		if self.awareness != Awareness.ALERT:
-			return False
-		dodge_target = int(self.speed) + 3
-		r = dice.roll()
-		return r <= dodge_target
+			return 0
+		return int(self.speed) + 3
 
 	def get(self, target):
 		if target is self:
@@ -337,7 +375,7 @@ class Actor(Entity):
 		self.delay += 10 # TODO: held items drop easier
 
 	def can_be_picked_up(self, picker):
-		if self.dodge(picker):
+		if dice.roll() <= self.dodge_target(picker):
 			self.raise_event(Event(visual = f"The {self.name} dodges the grab!"))
 			return False
 		return picker.ST > self.ST
@@ -346,5 +384,69 @@ class Actor(Entity):
 		distance = util.manhattan_dist(self.position, target)
 		if distance <= goal_distance:
 			return None
-		next_square = self.observer.tiles.next_step_towards(self.position, target)
-		return util.tup_sub(next_square, self.position)
\ No newline at end of file
+		next_square = self.next_path_step(tuple(target))
+		if next_square is None: # Unreachable, head straight for it
+			return util.dir_between(target, self.position)
+		return util.tup_sub(next_square, self.position)
+
+	# Follows the cached path while it's still good, only searching again when
+	# it can't be patched up
+	def next_path_step(self, target):
+		tiles = self.observer.tiles
+		if self._path and self.revalidate_path(tiles, target):
+			Actor.path_metrics["reused"] += 1
+		elif (field := tiles.shared_flow_field(target, self.position)) and field.reaches(self.position):
+			self._path = []
+			return field.step_from(self.position)
+		else:
+			self.replan_path(tiles, target)
+		if not self._path:
+			return None
+		return self._path.pop()
+
+	def replan_path(self, tiles, target):
+		self.replans += 1
+		Actor.path_metrics["replanned"] += 1
+		path = tiles.find_path(self.position, target)
+		self._path = path[::-1] if path else []
+		self.path_goal = target
+		self.path_version = tiles.cost_version
+
+	# Whether a live actor is standing at position. Corpses and items lying
+	# around don't get in the way
+	def crowded(self, position):
+		return any(isinstance(e, Actor) and not e.dead for e in self.observer.buckets.get(position, ()))
+
+	# Checks the cached path still leads somewhere useful, patching it locally
+	# where it can. Returns False if it has to be replanned
+	def revalidate_path(self, tiles, target):
+		if tiles.cost_version != self.path_version:
+			for x, y in self._path:
+				if tiles.traversal_cost(x, y) < 0:
+					return False
+			self.path_version = tiles.cost_version
+		next_step = self._path[-1]
+		if util.manhattan_dist(next_step, self.position) != 1:
+			return False # Knocked off the path
+		drift = util.manhattan_dist(self.path_goal, target)
+		if drift > self.PATH_TOLERANCE:
+			return False
+		if drift:
+			# Carry on from the old goal to where the target went
+			leg = tiles.heuristic(self.path_goal, target, self.PATH_TOLERANCE * 64)
+			if leg is None:
+				return False
+			self._path = leg[::-1] + self._path
+			self.path_goal = target
+			Actor.path_metrics["extended"] += 1
+		if tiles.traversal_cost(*next_step) < 0 or \
+			(next_step != target and self.crowded(next_step)):
+			# Blocked or crowded, route around it to a point further along
+			k = min(self.REPAIR_HORIZON, len(self._path))
+			waypoint = self._path[-k]
+			detour = tiles.heuristic(self.position, waypoint, self.REPAIR_HORIZON * self.REPAIR_HORIZON * 8)
+			if detour is None:
+				return False
+			self._path = self._path[:-k] + detour[::-1]
+			Actor.path_metrics["repaired"] += 1
+		return True
\ No newline at end of file
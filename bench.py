@@ -0,0 +1,43 @@
+# Memory benchmark. Spawns a crowd of actors, loose items and severed parts and
+# reports how much memory each one takes, body included.
+#
+# python bench.py [count]
+import sys
+import gc
+import tracemalloc
+from entity import *
+import loader
+from actor import *
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+mat_dict = loader.load_materials()
+template_dict = loader.load_templates()
+Entity.DEFAULT_MAT = mat_dict["flesh"]
+
+def measure(build):
+	gc.collect()
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	kept = build()
+	gc.collect()
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return (after - before) / count, kept
+
+def actors():
+	return [Actor.from_template("Zombie", (i % 100, i // 100), template_dict["human"], template_dict["zombie"]) for i in range(count)]
+
+def items():
+	return [Entity.from_template("axe", None, template_dict["axe"]) for i in range(count)]
+
+def severed():
+	parent = Actor.from_template("Human", (0, 0), template_dict["human"])
+	arm = parent.root_part.get_parts_with_trait(PartFlag.LEVER)[0]
+	return [Entity.from_part(arm, parent) for i in range(count)]
+
+print(f"{count} of each")
+for name, build in (("actor", actors), ("entity", items), ("severed part", severed)):
+	per_entity, kept = measure(build)
+	print(f"{name:>14}: {per_entity:8.0f} bytes each")
+	del kept
@@ -1,102 +1,324 @@
 import math
 import random
+from bisect import bisect
 from structs import BodyType, PartFlag
 
+# Bodies are stored flat. A BodyPlan holds everything about the shape of a
+# body, shared by every body built from it, with its parts in depth first order
+# so the subtree under a part is the run of parts from it up to its end index.
+# Each Body only holds the per instance state in lists indexed the same way:
+# damage, what's held, traits (crippling adds to them) and which parts are
+# still attached. BodyPart is a small handle pointing at one part of one body.
+# A body's version goes up whenever what it holds or which parts are attached
+# changes, so owners can cache anything worked out from those.
+
+TRAIT_BITS = {flag: 1 << i for i, flag in enumerate(PartFlag)}
+
+def trait_mask(traits):
+	mask = 0
+	for flag in traits:
+		mask |= TRAIT_BITS[flag]
+	return mask
+
+class BodyPlan:
+	__slots__ = ("names", "parents", "ends", "sizes", "hp_divisors", "traits", "weights", "_subplans")
+
+	def __init__(self, names, parents, sizes, hp_divisors, traits):
+		self.names = tuple(names)
+		self.parents = tuple(parents)
+		self.sizes = tuple(sizes)
+		self.hp_divisors = tuple(hp_divisors)
+		self.traits = tuple(traits)
+		# Chance of being hit relative to the other parts
+		self.weights = tuple(math.pow(1.5, size) for size in sizes)
+		ends = list(range(1, len(names) + 1))
+		for i in reversed(range(len(names))):
+			if (parent := parents[i]) >= 0:
+				ends[parent] = max(ends[parent], ends[i])
+		self.ends = tuple(ends)
+		self._subplans = {}
+
+	# Flattens a tree of (name, size, hp_divisor, traits, children) tuples
+	@classmethod
+	def from_tree(cls, tree):
+		names, parents, sizes, hp_divisors, traits = [], [], [], [], []
+		def add(node, parent):
+			name, size, hp_divisor, flags, children = node
+			index = len(names)
+			names.append(name)
+			parents.append(parent)
+			sizes.append(size)
+			hp_divisors.append(hp_divisor)
+			traits.append(trait_mask(flags))
+			for child in children:
+				add(child, index)
+		add(tree, -1)
+		return cls(names, parents, sizes, hp_divisors, traits)
+
+	def __len__(self):
+		return len(self.names)
+
+	# Plan for the subtree under a part on its own, with sizes shifted so the
+	# largest part is 0
+	def subplan(self, index):
+		if (plan := self._subplans.get(index)) is None:
+			end = self.ends[index]
+			sizes = self.sizes[index:end]
+			largest = max(sizes)
+			plan = self._subplans[index] = BodyPlan(
+				self.names[index:end],
+				[-1] + [parent - index for parent in self.parents[index + 1:end]],
+				[size - largest for size in sizes],
+				self.hp_divisors[index:end],
+				self.traits[index:end])
+		return plan
+
+class Body:
+	__slots__ = ("plan", "damage", "held", "holding", "traits", "attached", "root", "version", "_hit_table")
+
+	def __init__(self, plan):
+		count = len(plan)
+		self.plan = plan
+		self.damage = [0] * count
+		self.held = [None] * count
+		# Held entity -> index of the part holding it
+		self.holding = {}
+		self.traits = list(plan.traits)
+		self.attached = [True] * count
+		self.root = BodyPart(self, 0)
+		self.version = 0
+		self._hit_table = None
+
+	def part(self, index):
+		return BodyPart(self, index)
+
+	# Indices of the attached parts under index, itself included
+	def indices(self, index = 0):
+		attached = self.attached
+		return [i for i in range(index, self.plan.ends[index]) if attached[i]]
+
+	# First attached part under index with the trait, or -1
+	def find(self, trait, index = 0):
+		bit = TRAIT_BITS[trait]
+		attached = self.attached
+		traits = self.traits
+		for i in range(index, self.plan.ends[index]):
+			if attached[i] and traits[i] & bit:
+				return i
+		return -1
+
+	# Takes the subtree under index off the body. Returns what its parts were
+	# holding, which they let go of
+	def detach(self, index):
+		end = self.plan.ends[index]
+		self.attached[index:end] = [False] * (end - index)
+		released = []
+		for i in range(index, end):
+			if (target := self.held[i]) is not None:
+				self.held[i] = None
+				del self.holding[target]
+				released.append(target)
+		self._hit_table = None
+		self.version += 1
+		return released
+
+	# New body made of the subtree under index, carrying over its injuries.
+	# Anything held isn't carried over, detach lets go of it
+	def extract(self, index):
+		end = self.plan.ends[index]
+		body = Body(self.plan.subplan(index))
+		body.damage[:] = self.damage[index:end]
+		body.traits[:] = self.traits[index:end]
+		body.attached[:] = self.attached[index:end]
+		return body
+
+	def hold(self, index, target):
+		if (previous := self.held[index]) is not None:
+			del self.holding[previous]
+		self.held[index] = target
+		if target is not None:
+			self.holding[target] = index
+		self.version += 1
+
+	# Lets go of target wherever it's held, returns whether it was
+	def release(self, target):
+		if (index := self.holding.pop(target, None)) is None:
+			return False
+		self.held[index] = None
+		self.version += 1
+		return True
+
+	# (attached part indices, running total of their weights) for picking where
+	# a blow lands, kept until a part comes off
+	def hit_table(self):
+		if self._hit_table is None:
+			weights = self.plan.weights
+			parts = self.indices()
+			cum_weights = []
+			cum = 0
+			for i in parts:
+				cum += weights[i]
+				cum_weights.append(cum)
+			self._hit_table = (parts, cum_weights)
+		return self._hit_table
+
+	# Part a blow lands on, for a roll uniform over [0, 1)
+	def locate(self, roll):
+		parts, cum_weights = self.hit_table()
+		return parts[bisect(cum_weights, roll * cum_weights[-1], 0, len(parts) - 1)]
+
+	def random_index(self, index = 0):
+		if index == 0:
+			return self.locate(random.random())
+		attached = self.attached
+		weights = self.plan.weights
+		parts = []
+		cum_weights = []
+		cum = 0
+		for i in range(index, self.plan.ends[index]):
+			if attached[i]:
+				cum += weights[i]
+				parts.append(i)
+				cum_weights.append(cum)
+		return random.choices(parts, cum_weights = cum_weights, k = 1)[0]
+
+	# Hit locations for a whole volley at once
+	def random_indices(self, count):
+		parts, cum_weights = self.hit_table()
+		total = cum_weights[-1]
+		hi = len(parts) - 1
+		return [parts[bisect(cum_weights, random.random() * total, 0, hi)] for _ in range(count)]
+
 class BodyPart:
-	def __init__(self, name, size = 0, hp_divisor = False, traits = []):
-		self._children = []
-		self.held = None
-		self.name = name
-		self.traits = traits
-		self.size = size
-		self.hp_divisor = hp_divisor
-		self.damage = 0
-		self.parent = None
-
-	def normalize(self):
-		parts = self.get_part_list()
-		parts.sort(key = lambda x: x.size)
-		largest_size = parts[-1].size
-		for part in parts:
-			part.size -= largest_size
-
-	def add_children(self, *args):
-		for child in args:
-			child.parent = self
-			self._children.append(child)
-
-	def remove_child(self, child):
-		self._children.remove(child)
+	__slots__ = ("body", "index")
+
+	def __init__(self, body, index):
+		self.body = body
+		self.index = index
+
+	def __eq__(self, other):
+		return isinstance(other, BodyPart) and self.body is other.body and self.index == other.index
+
+	def __hash__(self):
+		return hash((id(self.body), self.index))
+
+	def __repr__(self):
+		return f"BodyPart({self.name!r})"
+
+	@property
+	def name(self):
+		return self.body.plan.names[self.index]
+
+	@property
+	def size(self):
+		return self.body.plan.sizes[self.index]
+
+	@property
+	def hp_divisor(self):
+		return self.body.plan.hp_divisors[self.index]
+
+	@property
+	def parent(self):
+		if (parent := self.body.plan.parents[self.index]) < 0:
+			return None
+		return BodyPart(self.body, parent)
+
+	@property
+	def damage(self):
+		return self.body.damage[self.index]
 
+	@damage.setter
+	def damage(self, value):
+		self.body.damage[self.index] = value
+
+	@property
+	def held(self):
+		return self.body.held[self.index]
+
+	@held.setter
+	def held(self, value):
+		self.body.hold(self.index, value)
+
+	@property
+	def attached(self):
+		return self.body.attached[self.index]
+
+	# List of the part's flags, has_trait is cheaper for checking one
+	@property
+	def traits(self):
+		mask = self.body.traits[self.index]
+		return [flag for flag, bit in TRAIT_BITS.items() if mask & bit]
+
+	def has_trait(self, trait):
+		return bool(self.body.traits[self.index] & TRAIT_BITS[trait])
+
+	def add_trait(self, trait):
+		self.body.traits[self.index] |= TRAIT_BITS[trait]
+
+	# Returns what the lost parts were holding
 	def kill(self):
-		if self.parent:
-			self.parent.remove_child(self)
+		if self.index: # The root has nothing to come off of
+			return self.body.detach(self.index)
+		return []
 
 	def get_part_list(self):
-		out_list = [self]
-		for part in self._children:
-			out_list += part.get_part_list()
-		return out_list
+		body = self.body
+		return [BodyPart(body, i) for i in body.indices(self.index)]
 
 	def get_parts_with_trait(self, trait):
-		return list(filter(lambda x: trait in x.traits, self.get_part_list()))
+		bit = TRAIT_BITS[trait]
+		body = self.body
+		traits = body.traits
+		return [BodyPart(body, i) for i in body.indices(self.index) if traits[i] & bit]
 
 	def get_weighted_random_part(self):
-		parts = self.get_part_list()
-		weights = []
-		cum = 0
-		for part in parts:
-			cum += math.pow(1.5, part.size)
-			weights.append(cum)
-		return random.choices(parts, cum_weights = weights, k = 1)[0]
+		return BodyPart(self.body, self.body.random_index(self.index))
 
 	def contains_trait(self, trait):
-		for part in self.get_part_list():
-			if trait in part.traits: return True
-		return False
+		return self.body.find(trait, self.index) >= 0
+
+# Body plans as trees of (name, size, hp_divisor, traits, children)
+PLANS = {
+	BodyType.HUMANOID: ("Torso", 0, False, [PartFlag.VITALS], [
+		("Neck", -5, False, [PartFlag.CUTTABLE], [
+			("Head", -7, False, [PartFlag.MIND], [
+				("Eyes", -9, 10, [PartFlag.SIGHT], []),
+			]),
+		]),
+		("Left arm", -2, 2, [PartFlag.LEVER], [
+			("Left hand", -4, 3, [PartFlag.SECONDARY_GRASPER, PartFlag.STRIKER], []),
+		]),
+		("Right arm", -2, 2, [PartFlag.LEVER], [
+			("Right hand", -4, 3, [PartFlag.GRASPER, PartFlag.STRIKER], []),
+		]),
+		("Left leg", -2, 2, [PartFlag.LEVER, PartFlag.WALKER], [
+			("Left Foot", -4, 3, [PartFlag.BALANCER, PartFlag.STRIKER], []),
+		]),
+		("Right leg", -2, 2, [PartFlag.LEVER, PartFlag.WALKER], [
+			("Right Foot", -4, 3, [PartFlag.BALANCER, PartFlag.STRIKER], []),
+		]),
+	]),
+	BodyType.CARCINOID: ("Thorax", 0, False, [PartFlag.VITALS], [
+		("Head", -7, False, [PartFlag.MIND], [
+			("Eyes", -9, 10, [PartFlag.SIGHT], []),
+		]),
+		("Left arm", -2, 2, [PartFlag.LEVER], [
+			("Left hand", -4, 3, [PartFlag.SECONDARY_GRASPER, PartFlag.STRIKER], []),
+		]),
+		("Right arm", -2, 2, [PartFlag.LEVER], [
+			("Right hand", -4, 3, [PartFlag.GRASPER, PartFlag.STRIKER], []),
+		]),
+		("Front right leg", -2, 2, [PartFlag.LEVER, PartFlag.WALKER, PartFlag.BALANCER], []),
+		("Front left leg", -2, 2, [PartFlag.LEVER, PartFlag.WALKER, PartFlag.BALANCER], []),
+		("Back right leg", -2, 2, [PartFlag.LEVER, PartFlag.WALKER], []),
+		("Back left leg", -2, 2, [PartFlag.LEVER, PartFlag.WALKER, PartFlag.BALANCER], []),
+	]),
+}
+SIMPLE_PLAN = ("Mass", 0, False, [PartFlag.SIMPLE], [])
+
+compiled_plans = {}
 
 def construct_body(bodyplan):
-	if bodyplan == BodyType.HUMANOID:
-		root = BodyPart("Torso", 0, traits = [PartFlag.VITALS])
-		neck = BodyPart("Neck", -5, traits = [PartFlag.CUTTABLE])
-		head = BodyPart("Head", -7, traits = [PartFlag.MIND])
-		eyes = BodyPart("Eyes", -9, 10, traits = [PartFlag.SIGHT])
-		l_arm = BodyPart("Left arm", -2, 2, traits = [PartFlag.LEVER])
-		r_arm = BodyPart("Right arm", -2, 2, traits = [PartFlag.LEVER])
-		l_hand = BodyPart("Left hand", -4, 3, traits = [PartFlag.SECONDARY_GRASPER, PartFlag.STRIKER])
-		r_hand = BodyPart("Right hand", -4, 3, traits = [PartFlag.GRASPER, PartFlag.STRIKER])
-		l_leg = BodyPart("Left leg", -2, 2, traits = [PartFlag.LEVER, PartFlag.WALKER])
-		r_leg = BodyPart("Right leg", -2, 2, traits = [PartFlag.LEVER, PartFlag.WALKER])
-		l_foot = BodyPart("Left Foot", -4, 3, traits = [PartFlag.BALANCER, PartFlag.STRIKER])
-		r_foot = BodyPart("Right Foot", -4, 3, traits = [PartFlag.BALANCER, PartFlag.STRIKER])
-		
-		root.add_children(neck, l_arm, r_arm, l_leg, r_leg)
-		neck.add_children(head)
-		head.add_children(eyes)
-		l_arm.add_children(l_hand)
-		r_arm.add_children(r_hand)
-		l_leg.add_children(l_foot)
-		r_leg.add_children(r_foot)
-
-		return root
-	elif bodyplan == BodyType.CARCINOID:
-		root = BodyPart("Thorax", 0, traits = [PartFlag.VITALS])
-		head = BodyPart("Head", -7, traits = [PartFlag.MIND])
-		eyes = BodyPart("Eyes", -9, 10, traits = [PartFlag.SIGHT])
-		l_arm = BodyPart("Left arm", -2, 2, traits = [PartFlag.LEVER])
-		r_arm = BodyPart("Right arm", -2, 2, traits = [PartFlag.LEVER])
-		l_hand = BodyPart("Left hand", -4, 3, traits = [PartFlag.SECONDARY_GRASPER, PartFlag.STRIKER])
-		r_hand = BodyPart("Right hand", -4, 3, traits = [PartFlag.GRASPER, PartFlag.STRIKER])
-		front_l_leg = BodyPart("Front left leg", -2, 2, traits = [PartFlag.LEVER, PartFlag.WALKER, PartFlag.BALANCER])
-		back_l_leg = BodyPart("Back left leg", -2, 2, traits = [PartFlag.LEVER, PartFlag.WALKER, PartFlag.BALANCER])
-		front_r_leg = BodyPart("Front right leg", -2, 2, traits = [PartFlag.LEVER, PartFlag.WALKER, PartFlag.BALANCER])
-		back_r_leg = BodyPart("Back right leg", -2, 2, traits = [PartFlag.LEVER, PartFlag.WALKER])
-
-		root.add_children(head, l_arm, r_arm, front_r_leg, front_l_leg, back_r_leg, back_l_leg)
-		head.add_children(eyes)
-		l_arm.add_children(l_hand)
-		r_arm.add_children(r_hand)
-
-		return root
-	else:
-		return BodyPart("Mass", 0, traits = [PartFlag.SIMPLE])
\ No newline at end of file
+	if (plan := compiled_plans.get(bodyplan)) is None:
+		plan = compiled_plans[bodyplan] = BodyPlan.from_tree(PLANS.get(bodyplan, SIMPLE_PLAN))
+	return Body(plan)
@@ -0,0 +1,155 @@
+import numpy as np
+import dice
+from structs import DamageType, PartFlag, Event
+from body import BodyPart, TRAIT_BITS
+
+# Attacks land the moment they're made. Everything goes through resolve(), a
+# single blow being a volley of one, which works in three passes:
+#
+#  1. Every random number the volley needs is drawn at once: dodge rolls and
+#     damage dice with numpy, hit locations a body at a time with
+#     Body.random_indices. Raw damage is worked out for the whole volley in one
+#     go, with multipliers read from a table.
+#  2. Attacks land one at a time in the order they were made. Only the
+#     arithmetic that depends on earlier blows is done here: capping damage at
+#     what a part can still take and taking it off the target's hit points.
+#  3. Side effects are applied in a fixed order once everything has landed:
+#     crippled, severed and pulped parts in the order they were dealt, only
+#     the worst injury to each part counting; then bloodstains; then death
+#     checks, for each target in the order it was first hit.
+#
+# Attacks with no power roll their damage_dice d6 + damage_mod when they land,
+# and attacks with no part to aim at, or aimed at a part that has come off,
+# land on a random part instead.
+
+DAMAGE_TYPES = tuple(DamageType)
+DAMAGE_TYPE_CODES = {damage_type: i for i, damage_type in enumerate(DAMAGE_TYPES)}
+
+def damage_multiplier(damage_type, cuttable, injury_tolerant):
+	match damage_type:
+		case DamageType.CUT:
+			return 2 if cuttable else 1.5
+		case DamageType.PIERCE_SMALL:
+			return .2 if injury_tolerant else .5
+		case DamageType.PIERCE:
+			return .33 if injury_tolerant else 1
+		case DamageType.PIERCE_LARGE:
+			return .5 if injury_tolerant else 1.5
+		case DamageType.PIERCE_HUGE | DamageType.IMPALE:
+			return 1 if injury_tolerant else 2
+	return 1
+
+# [damage type code, part is cuttable, target is injury tolerant] -> multiplier
+MULTIPLIERS = np.array([[[damage_multiplier(damage_type, cuttable, tolerant)
+	for tolerant in (False, True)]
+	for cuttable in (False, True)]
+	for damage_type in DAMAGE_TYPES])
+
+CUTTABLE_BIT = TRAIT_BITS[PartFlag.CUTTABLE]
+CRIPPLED = PartFlag.CRIPPLED
+
+def dodged(attacker, target):
+	target.raise_event(Event(visual = f"{attacker.name} attacks the {target.name}, but {target.pronoun} dodges!"))
+
+# Deals damage to part index of the target, recording any major injury it
+# causes in injuries. Returns the damage dealt after capping
+def land(attacker, target, attack, index, damage, injuries):
+	body = target.body
+	uncapped = damage
+	divisor = body.plan.hp_divisors[index]
+	if divisor:
+		hp_max = target.hp_max
+		damage = min(damage, hp_max // divisor - body.damage[index])
+	body.damage[index] += damage
+	target.hp -= damage
+	damage_num_color = 'r' if damage > 0 else 'g'
+	target.raise_event(Event(visual = f"{attacker.name} attacks {target.name} in the {body.plan.names[index]} for [{damage_num_color}]{damage}[w] damage!"))
+	if divisor:
+		major_injury_threshold = hp_max // divisor + (hp_max % divisor > 0)
+		if body.damage[index] >= major_injury_threshold:
+			severity = 2 if uncapped > major_injury_threshold * 2 else 1
+			key = (target, index)
+			if severity > injuries.get(key, (0,))[0]:
+				injuries[key] = (severity, attack.damage_type)
+	return damage
+
+# Side effects once the attacks have landed, in the order described above
+def aftermath(injuries, bleeding, hit):
+	for (target, index), (severity, damage_type) in injuries.items():
+		part = BodyPart(target.body, index)
+		if not part.attached or part.has_trait(CRIPPLED):
+			continue
+		if severity == 1:
+			part.add_trait(CRIPPLED)
+			target.raise_event(Event(visual = f"The {target.name}'s {part.name} is [r]crippled[w] by the blow!"))
+		elif damage_type == DamageType.CUT:
+			target.sever(part)
+			target.raise_event(Event(visual = f"The {target.name}'s {part.name} is [r]severed[w] by the attack!"))
+		else:
+			target.lose_part(part)
+			target.raise_event(Event(visual = f"The {target.name}'s {part.name} is [r]pulped[w] by the attack!"))
+	for target in bleeding:
+		target.bleed()
+	for target in hit:
+		target.check_death()
+
+# Returns the damage the attack did, 0 if it was dodged
+def strike(attacker, target, attack):
+	return resolve([(attacker, target, attack)])[0]
+
+# Returns the damage each attack did, 0 for ones that were dodged
+def resolve(attacks):
+	count = len(attacks)
+	if count == 0:
+		return []
+	generator = dice.stream.generator
+	dodge_rolls = dice.rolls(count).tolist()
+	# Hit locations for the attacks without a part to aim at, drawn for each
+	# body at once
+	unaimed = {}
+	for i, (attacker, target, attack) in enumerate(attacks):
+		if (part := attack.target) is None or not target.body.attached[part.index]:
+			unaimed.setdefault(target.body, []).append(i)
+	parts = [attack.target.index if attack.target is not None else 0 for _, _, attack in attacks]
+	for body, indices in unaimed.items():
+		for i, index in zip(indices, body.random_indices(len(indices))):
+			parts[i] = index
+	dodge_targets = [0] * count
+	codes = np.empty(count, dtype = np.intp)
+	cuttable = np.empty(count, dtype = np.intp)
+	tolerant = np.empty(count, dtype = np.intp)
+	powers = np.empty(count)
+	hardness = np.empty(count)
+	dice_counts = np.zeros(count, dtype = np.intp)
+	for i, (attacker, target, attack) in enumerate(attacks):
+		target.wake()
+		dodge_targets[i] = target.dodge_target(attacker)
+		codes[i] = DAMAGE_TYPE_CODES[attack.damage_type]
+		cuttable[i] = target.body.traits[parts[i]] & CUTTABLE_BIT > 0
+		tolerant[i] = target.traits.get('injury_tolerance', None) is not None
+		if attack.power is None:
+			dice_counts[i] = attack.damage_dice
+			powers[i] = attack.damage_mod
+		else:
+			powers[i] = attack.power
+		hardness[i] = target.material.hardness
+	if (most := dice_counts.max()) > 0:
+		faces = generator.integers(1, 7, (count, most))
+		powers += (faces * (np.arange(most) < dice_counts[:, None])).sum(axis = 1)
+	# TODO: armor
+	damages = np.floor(np.maximum(0, powers - hardness) * MULTIPLIERS[codes, cuttable, tolerant]).astype(int).tolist()
+
+	dealt = [0] * count
+	injuries = {} # (target, part index) -> (severity, damage type)
+	bleeding = {}
+	hit = {}
+	for i, (attacker, target, attack) in enumerate(attacks):
+		if dodge_rolls[i] <= dodge_targets[i]:
+			dodged(attacker, target)
+			continue
+		dealt[i] = damage = land(attacker, target, attack, parts[i], damages[i], injuries)
+		if damage > 0:
+			bleeding[target] = True
+		hit[target] = True
+	aftermath(injuries, bleeding, hit)
+	return dealt
@@ -1,4 +1,65 @@
-from random import randint
+import random
+import numpy as np
 
-def roll(num = 3, sides = 6, mod = 0):
-	return sum([randint(1, sides) for i in range(num)]) + mod
\ No newline at end of file
+# Dice are rolled out of blocks made ahead of time. For every kind of roll asked
+# for (number of dice, sides) the stream keeps a list of finished totals drawn
+# from a numpy Generator a block at a time, so a roll just takes the next one
+# off the list. Each total is the sum of independent uniform die faces, exactly
+# as if the dice had been rolled one by one.
+#
+# seed() restarts the stream from a known state, after which every roll and
+# anything else drawn from the stream's generator comes out the same each time.
+# The module level seed() seeds the random module along with the shared stream,
+# so the rest of the game's chance comes out the same too.
+
+BLOCK_SIZE = 4096
+
+class DiceStream:
+	def __init__(self, seed = None, block_size = BLOCK_SIZE):
+		self.block_size = block_size
+		self.seed(seed)
+
+	def seed(self, value = None):
+		self.generator = np.random.default_rng(value)
+		# (num, sides) -> totals not handed out yet
+		self.blocks = {}
+
+	def refill(self, num, sides):
+		totals = self.generator.integers(1, sides + 1, (self.block_size, num)).sum(axis = 1).tolist()
+		self.blocks[(num, sides)] = totals
+		return totals
+
+	def roll(self, num = 3, sides = 6, mod = 0):
+		num = max(num, 0) # No dice at all rolls just the modifier
+		if not (totals := self.blocks.get((num, sides))):
+			totals = self.refill(num, sides)
+		return totals.pop() + mod
+
+	# Array of count rolls at once
+	def rolls(self, count, num = 3, sides = 6, mod = 0):
+		return self.generator.integers(1, sides + 1, (count, max(num, 0))).sum(axis = 1) + mod
+
+stream = DiceStream(random.getrandbits(64))
+roll = stream.roll
+rolls = stream.rolls
+
+def seed(value = None):
+	stream.seed(value)
+	random.seed(value)
+
+# Basic thrust or swing damage for a given ST as (dice, modifier)
+def basic_damage(ST, swing):
+	effective_ST = ST + max(2, ST - 7) if swing else ST
+	damage_dice = max((effective_ST - 3) // 8, 1)
+	damage_mod = (effective_ST - 3) % 8 // 2 - 1 if effective_ST >= 11 else (effective_ST + 1) // 2 - 7
+	return (damage_dice, damage_mod)
+
+# basic_damage worked out ahead of time for every ST up to this
+DAMAGE_TABLE_SIZE = 64
+THRUST_TABLE = [basic_damage(ST, False) for ST in range(DAMAGE_TABLE_SIZE)]
+SWING_TABLE = [basic_damage(ST, True) for ST in range(DAMAGE_TABLE_SIZE)]
+
+def damage_dice(ST, swing):
+	if type(ST) == int and 0 <= ST < DAMAGE_TABLE_SIZE:
+		return SWING_TABLE[ST] if swing else THRUST_TABLE[ST]
+	return basic_damage(ST, swing)
@@ -1,11 +1,15 @@
 import random
 import math
+import numpy as np
 import util
 from structs import *
 import dice
-from copy import deepcopy
-from collections import defaultdict
-from body import BodyPart, construct_body
+import combat
+from spatial import SpatialIndex
+from heapq import heappush, heappop, heapify
+from itertools import count
+from operator import attrgetter
+from body import construct_body
 
 default_entity_attributes = {
 	"attribute": {
@@ -46,7 +50,8 @@ default_entity_attributes = {
 #                   in the game world, not the EntityContainer object which
 #                   manages the entity.
 # delay           - The number of ticks until the entity's update() method is
-#                   called.
+#                   called. Setting it puts a suspended entity back on the
+#                   schedule.
 # is_player       - Self explanatory.
 # pronoun         - The pronoun used when constructing messages about the
 #                   entity for display.
@@ -63,7 +68,10 @@ default_entity_attributes = {
 #                   attack templates.
 # ranged_attacks  - Same as above for ranged attacks.
 # ammo            - List of ways the entity can be used as ammunition.
-# factions        - List of tags used by AI to react to things.
+# factions        - Set of tags used by AI to react to things. Entities that
+#                   share no faction are hostile to each other.
+# faction_mask    - The factions as a bitmask, see faction_mask(). Kept in
+#                   step with factions, set factions to change it.
 # hp_max          - Self explanatory. Property, cannot be set as it is derived
 #                   from other attributes.
 # hp              - Hitpoints. Remaining physical durability.
@@ -75,20 +83,255 @@ default_entity_attributes = {
 #                   otherwise put under stress. 10 is average.
 # dead            - Entity is deceased or otherwise completely nonfunctional
 # death_checks    - How many HT rolls the entity has made to avoid death.
+# body            - The entity's Body, see body.py.
+# root_part       - BodyPart handle for the root of the body. Property.
+
+# Faction names are interned to bits the first time they're seen so faction
+# membership can be compared with a single integer AND
+faction_bits = {}
+
+def faction_mask(factions):
+	mask = 0
+	for name in factions:
+		if (bit := faction_bits.get(name)) is None:
+			bit = faction_bits[name] = 1 << len(faction_bits)
+		mask |= bit
+	return mask
+
+# The result of merging a chain of templates over a class's DEFAULT_TEMPLATE.
+# Everything in it is shared between the entities spawned from it apart from
+# the display, which is turned into a new Glyph for each, and the traits, which
+# each gets its own copy of.
+class CompiledTemplate:
+	__slots__ = ("display", "attributes", "bodyplan", "traits", "factions",
+		"melee_attacks", "ranged_attacks", "ammo")
+
+	def __init__(self, cls, templates):
+		full_template = util.deep_update(cls.DEFAULT_TEMPLATE, {})
+		for template in templates:
+			full_template = util.deep_update(full_template, template)
+
+		for attribute in full_template["attribute"]:
+			if attribute not in cls.ATTRIBUTES:
+				raise ValueError(f"Unknown attribute {attribute} in template for {cls.__name__}")
+		self.display = full_template["display"]
+		self.attributes = tuple(full_template["attribute"].items())
+		self.bodyplan = full_template["bodyplan"]
+		self.traits = full_template["trait"]
+		self.factions = frozenset(full_template["factions"])
+		self.melee_attacks = full_template["melee_attacks"]
+		self.ranged_attacks = full_template["ranged_attacks"]
+		self.ammo = full_template["ammo"]
+
+# (class, names of the templates in the chain) -> CompiledTemplate
+compiled_templates = {}
+
+AWARENESS = list(Awareness)
+AWARENESS_CODES = {a: i for i, a in enumerate(AWARENESS)}
+# Code in the awareness column of rows for things that have no awareness
+AWARENESS_UNSET = len(AWARENESS)
+AWARENESS_DECODE = (*AWARENESS, None)
+
+# hp and attributes are stored as floats since materials with fractional
+# density give fractional hp, whole values come back out as the ints they went
+# in as
+def whole(value):
+	return int(value) if value.is_integer() else value
+
+# Optional struct of arrays layout for the numbers the container works on in
+# bulk. Every entity on a container's schedule while Entity.STORE is set has a
+# row, and the attributes below read and write its column entries instead of
+# the entity's own slots, so the container can select and sweep entities with
+# array operations rather than Python loops. Rows are given back when an entity
+# is suspended, its values going back into its slots, and handed out again to
+# whatever is scheduled next. Install it with use_store() before adding
+# anything to a container:
+#
+#   use_store(ComponentStore())
+#
+# Without a store the attributes are the plain slots, so nothing pays for the
+# indirection. Entities due each tick still come off the scheduling heap, which
+# only looks at the ones that are due, rather than out of a mask over the wake
+# column, which would look at every row.
+class ComponentStore:
+	# name -> (dtype, value for rows nothing has been written to)
+	COLUMNS = {
+		"wake": (np.float64, 0),
+		"hp": (np.float64, 0),
+		"ST": (np.float64, 10),
+		"HT": (np.float64, 10),
+		"DX": (np.float64, 10),
+		"IQ": (np.float64, 10),
+		"x": (np.int32, 0),
+		"y": (np.int32, 0),
+		"placed": (np.bool_, False), # Has a position, i.e. isn't held
+		"awareness": (np.int8, AWARENESS_UNSET), # Index into AWARENESS
+		"dead": (np.bool_, False),
+		"active": (np.bool_, False), # On its container's schedule
+		"player": (np.bool_, False),
+	}
+
+	def __init__(self, capacity = 1024):
+		self.size = 0
+		# Row -> entity using it, None for free rows
+		self.entities = []
+		self.free = []
+		self.columns = {name: np.full(capacity, default, dtype = dtype) for name, (dtype, default) in self.COLUMNS.items()}
+
+	# Gives entity a row, moving whatever it already has in its slots there
+	def attach(self, entity):
+		values = []
+		for component in components(type(entity)):
+			try:
+				values.append((component, component.descriptor.__get__(entity)))
+			except AttributeError:
+				pass
+		if self.free:
+			row = self.free.pop()
+			self.entities[row] = entity
+		else:
+			capacity = len(self.columns["wake"])
+			if self.size == capacity:
+				for name, (dtype, default) in self.COLUMNS.items():
+					grown = np.full(capacity * 2, default, dtype = dtype)
+					grown[:capacity] = self.columns[name]
+					self.columns[name] = grown
+			row = self.size
+			self.entities.append(entity)
+			self.size += 1
+		position = entity._position
+		entity._row = row
+		columns = self.columns
+		for component, value in values:
+			columns[component.column][row] = value if component.encode is None else component.encode(value)
+		columns["placed"][row] = position is not None
+		if position is not None:
+			columns["x"][row], columns["y"][row] = position
+		columns["player"][row] = entity.is_player
+
+	# Moves entity's values back into its slots and frees its row
+	def release(self, entity):
+		row = entity._row
+		values = [(component, component.__get__(entity)) for component in components(type(entity))]
+		position = entity.position
+		entity._row = None
+		for component, value in values:
+			component.descriptor.__set__(entity, value)
+		entity._position = position
+		for name, (dtype, default) in self.COLUMNS.items():
+			self.columns[name][row] = default
+		self.entities[row] = None
+		self.free.append(row)
+
+	# The in use part of a column
+	def view(self, name):
+		return self.columns[name][:self.size]
+
+	# Entities in the rows where mask is set. Free rows are left at their
+	# defaults, so a mask that needs any flag set never picks them
+	def select(self, mask):
+		entities = self.entities
+		return [entities[row] for row in np.flatnonzero(mask).tolist()]
+
+# Every Component defined, in the order their classes were
+COMPONENTS = []
+# class -> its Components, looked up once per class
+_components = {}
+
+def components(cls):
+	if (found := _components.get(cls)) is None:
+		found = _components[cls] = [component for component in COMPONENTS if issubclass(cls, component.owner)]
+	return found
+
+def use_store(store):
+	Entity.STORE = store
+	for component in COMPONENTS:
+		setattr(component.owner, component.name, component if store is not None else component.plain)
+
+# Attribute kept in a slot on the entity, or in a ComponentStore column if the
+# entity has a row there. Only put on its class while a store is in use, the
+# rest of the time the class has the plain version, which reads the slot
+# directly
+class Component:
+	def __init__(self, slot = None, decode = None, encode = None, derives = False, hearing = False):
+		self.slot = slot
+		self.decode = decode
+		self.encode = encode
+		# Whether cached derived stats depend on it
+		self.derives = derives
+		# Whether the container's hearing radius depends on it
+		self.hearing = hearing
+
+	def __set_name__(self, owner, name):
+		self.owner = owner
+		self.name = name
+		self.column = name.lstrip("_")
+		self.descriptor = descriptor = owner.__dict__[self.slot or "_" + name]
+		if self.derives or self.hearing:
+			def set_plain(entity, value):
+				descriptor.__set__(entity, value)
+				self.changed(entity, value)
+			self.plain = property(attrgetter(descriptor.__name__), set_plain)
+		else:
+			self.plain = descriptor
+		COMPONENTS.append(self)
+		setattr(owner, name, self if owner.STORE is not None else self.plain)
+
+	def __get__(self, entity, owner = None):
+		if entity is None:
+			return self
+		if (row := entity._row) is None:
+			return self.descriptor.__get__(entity, owner)
+		value = Entity.STORE.columns[self.column].item(row)
+		return value if self.decode is None else self.decode(value)
+
+	def __set__(self, entity, value):
+		if (row := entity._row) is None:
+			self.descriptor.__set__(entity, value)
+		else:
+			Entity.STORE.columns[self.column][row] = value if self.encode is None else self.encode(value)
+		self.changed(entity, value)
+
+	def changed(self, entity, value):
+		if self.derives:
+			entity.invalidate_stats()
+		if self.hearing and entity.observer is not None:
+			entity.observer.raise_hearing(value)
 
 class Entity:
 	DEFAULT_MAT = None
 	DEFAULT_TEMPLATE = default_entity_attributes
+	STORE = None
+	# Everything a template's "attribute" section may set
+	ATTRIBUTES = ("size", "ST", "HT", "DX", "IQ")
+	__slots__ = (
+		"size", "_ST", "_HT", "_DX", "_IQ", "_hp", "_dead", "_wake_slot", "_row",
+		"name", "_contents", "_position", "container", "observer", "_ticket",
+		"is_player", "pronoun", "_material", "_traits", "_hp_max", "melee_attacks", "ranged_attacks",
+		"ammo", "_factions", "faction_mask", "death_checks", "display_tile", "body")
+
+	ST = Component(decode = whole, derives = True)
+	HT = Component(decode = whole, derives = True)
+	DX = Component(decode = whole, derives = True)
+	IQ = Component(decode = whole, hearing = True)
+	hp = Component(decode = whole)
+	dead = Component()
+	_wake = Component(slot = "_wake_slot")
 
 	def __init__(self, name, position, is_player = False):
+		self._row = None
+		self.is_player = is_player
+		self._position = None
 		self.name = name
 		self._contents = []
-		self._position = position
+		self._hp_max = None
+		self.position = position
 		self.container = None
+		self.observer = None
+		self._wake = 0
+		self._ticket = None
 		self.delay = dice.roll()
-		self.is_player = is_player
 		self.pronoun = "it"
-		self.observer = None
 		self.material = Entity.DEFAULT_MAT
 		self.traits = {}
 		self.melee_attacks = []
@@ -101,39 +344,48 @@ class Entity:
 	@classmethod
 	def from_template(cls, name, position, *templates, is_player = False):
 		e = cls(name, position, is_player)
-
-		full_template = util.deep_update(cls.DEFAULT_TEMPLATE, {})
-		for template in templates:
-			full_template = util.deep_update(full_template, template)
-
-		e.display_tile = Glyph(**full_template["display"])
-
-		for attribute in full_template["attribute"]:
-			setattr(e, attribute, full_template["attribute"][attribute])
-
-		e.root_part = construct_body(full_template["bodyplan"])
-		e.traits = full_template["trait"]
-		e.factions = set(full_template["factions"])
-		e.melee_attacks = full_template["melee_attacks"]
-		e.ranged_attacks = full_template["ranged_attacks"]
-		e.ammo = full_template["ammo"]
+		compiled = cls.compile_templates(templates)
+
+		e.display_tile = Glyph(**compiled.display)
+		for attribute, value in compiled.attributes:
+			setattr(e, attribute, value)
+		e.body = construct_body(compiled.bodyplan)
+		e.traits = dict(compiled.traits)
+		e.factions = compiled.factions
+		e.melee_attacks = compiled.melee_attacks
+		e.ranged_attacks = compiled.ranged_attacks
+		e.ammo = compiled.ammo
 		e.hp = e.hp_max
 
 		return e
 
+	# Merging a chain of templates is done once per class and chain, after that
+	# spawning only builds the parts each entity gets its own copy of. Chains are
+	# told apart by the names loader.load_templates gives each template, ones
+	# with a template that has no name are merged afresh every time. Templates
+	# must not be changed once something has been spawned from them
+	@classmethod
+	def compile_templates(cls, templates):
+		names = tuple(template.get("name") for template in templates)
+		if None in names:
+			return CompiledTemplate(cls, templates)
+		key = (cls, names)
+		if (compiled := compiled_templates.get(key)) is None:
+			compiled = compiled_templates[key] = CompiledTemplate(cls, templates)
+		return compiled
+
 	@classmethod
 	def from_part(cls, part, parent):
 		name = f"{parent.name} severed {part.name}"
 		e = cls(name, parent.position)
 		e.material = parent.material
-		e.root_part = deepcopy(part)
-		e.size = e.root_part.size + parent.size
-		e.root_part.normalize()
+		e.body = part.body.extract(part.index)
+		e.size = part.size + parent.size
 		e.ST = math.ceil(math.pow(1.5, e.size) * parent.ST)
 		e.HT = 10
 		e.display_tile = Glyph('%', (0, 0, 0), (200, 0, 0)) # TODO: Change glyph based on part traits
 
-		root_is_lever = PartFlag.LEVER in e.root_part.traits
+		root_is_lever = e.root_part.has_trait(PartFlag.LEVER)
 		improvised_attack_skill = Skill.BRAWLING
 		if root_is_lever:
 			if e.size > -2:
@@ -164,19 +416,58 @@ class Entity:
 				result += x
 		return result
 
+	@property
+	def factions(self):
+		return self._factions
+
+	@factions.setter
+	def factions(self, new):
+		self._factions = frozenset(new)
+		self.faction_mask = faction_mask(self._factions)
+
+	def is_hostile_to(self, other):
+		return not self.faction_mask & other.faction_mask
+
 	@property
 	def position(self):
-		return self._position
+		if (row := self._row) is None:
+			return self._position
+		columns = Entity.STORE.columns
+		if not columns["placed"][row]:
+			return None
+		return (columns["x"].item(row), columns["y"].item(row))
 
 	@position.setter
 	def position(self, new):
-		old = self._position
-		self._position = new
+		old = self.position
+		if (row := self._row) is None:
+			self._position = new
+		else:
+			columns = Entity.STORE.columns
+			columns["placed"][row] = new is not None
+			if new is not None:
+				columns["x"][row], columns["y"][row] = new
 		try:
 			self.observer.rebucket(self, old, new)
 		except AttributeError:
 			pass
 
+	# Stored as an absolute wake up time while the entity is managed by an
+	# EntityContainer so that waiting entities cost nothing per tick. Before
+	# that it is kept relative and converted in add_entity.
+	@property
+	def delay(self):
+		if self.observer is None:
+			return self._wake
+		return self._wake - self.observer.time
+
+	@delay.setter
+	def delay(self, value):
+		if self.observer is None:
+			self._wake = value
+		else:
+			self.observer.schedule(self, self.observer.time + value)
+
 	@property
 	def global_position(self):
 		x = self
@@ -184,14 +475,49 @@ class Entity:
 			x = x.container
 		return x.position
 	
+	@property
+	def root_part(self):
+		return self.body.root
+
+	# Derived stats are cached until an attribute, the traits or the material
+	# they come from is set again. Traits are shared with the template the
+	# entity came from, replace them rather than changing them in place
+	@property
+	def material(self):
+		return self._material
+
+	@material.setter
+	def material(self, new):
+		self._material = new
+		self.invalidate_stats()
+
+	@property
+	def traits(self):
+		return self._traits
+
+	@traits.setter
+	def traits(self, new):
+		self._traits = new
+		self.invalidate_stats()
+
+	def invalidate_stats(self):
+		self._hp_max = None
+
 	@property
 	def hp_max(self):
-		return self.ST * self.material.density + self.traits.get("hp_boost", 0)
+		if (hp_max := self._hp_max) is None:
+			hp_max = self._hp_max = self.ST * self.material.density + self.traits.get("hp_boost", 0)
+		return hp_max
 
 	def sever(self, part):
 		new_entity = Entity.from_part(part, self)
 		self.observer.add_entity(new_entity)
-		part.kill()
+		self.lose_part(part)
+
+	# Takes part off the body, anything it was holding falls to the ground
+	def lose_part(self, part):
+		for target in part.kill():
+			self.remove(target)
 
 	# Consider giving this function a return value as a way to pass signals to the game state
 	# e.g. if the object is a light source and it changes how much light it gives off its
@@ -199,7 +525,18 @@ class Entity:
 	# engine to recalculate lighting
 	def update(self):
 		#print(f"The {self.name} continues being a {self.name}.")
-		self.delay = random.randint(1000, 10000)
+		self.suspend()
+
+	# Takes the entity off the schedule entirely until something wakes it
+	def suspend(self):
+		if self.observer:
+			self.observer.suspend(self)
+
+	# Puts a suspended entity back on the schedule, e.g. when it's hit or
+	# revived
+	def wake(self, delay = 1):
+		if self.observer:
+			self.observer.wake(self, delay)
 
 	def emit_sound(self, descriptor, volume = 0.0):
 		e = Event(
@@ -218,9 +555,13 @@ class Entity:
 	def process_event(self, event):
 		return
 
+	# Whether the entity wants to know what it can see when it's due to act
+	def perceives(self):
+		return False
+
 	def spawn_effect(self, effect):
 		if self.observer:
-			self.observer.effects.append(effect)
+			self.observer.add_effect(effect)
 
 	def apply_delta(self, delta):
 		new = (self.position[0] + delta[0], self.position[1] + delta[1])
@@ -228,8 +569,7 @@ class Entity:
 
 	def cost_to(self, direction):
 		new_position = util.tup_add(self.position, direction)
-		target_tile = self.observer.tiles.get_tile(*new_position)
-		return target_tile.traversal_cost() * (1 + util.is_diag(direction) * 0.4)
+		return self.observer.tiles.traversal_cost(*new_position) * (1 + util.is_diag(direction) * 0.4)
 
 	def move(self, direction):
 		if self.position is None: return False
@@ -243,42 +583,21 @@ class Entity:
 			self.delay = 10
 		return traversible
 
+	# Lands a single attack, see combat.py
 	def receive_attack(self, attacker, attack):
-		# TODO: armor
-		damage = max(0, attack.power - self.material.hardness)
-		target_part = attack.target
-		if target_part is None:
-			target_part = self.root_part.get_weighted_random_part()
-		# Damage type/target part multipliers
-		multiplier = util.calculate_damage_multiplier(attack.damage_type, target_part, self.traits.get('injury_tolerance', None))
-		damage = math.floor(damage * multiplier)
-		uncapped_damage = damage
-		major_injury_threshold = \
-			self.hp_max // target_part.hp_divisor + (self.hp_max % target_part.hp_divisor > 0) \
-			if target_part.hp_divisor else None
-		if target_part.hp_divisor:
-			maximum = self.hp_max // target_part.hp_divisor - target_part.damage
-			damage = min(damage, maximum)
-		target_part.damage += damage
-		self.hp -= damage
-		damage_num_color = 'r' if damage > 0 else 'g'
-		attack_descriptor = f"{attacker.name} attacks {self.name} in the {target_part.name} for [{damage_num_color}]{damage}[w] damage!"
-		self.raise_event(Event(visual = attack_descriptor))
-		if target_part.hp_divisor and target_part.damage >= major_injury_threshold and PartFlag.CRIPPLED not in target_part.traits:
-			if uncapped_damage > (major_injury_threshold * 2):
-				if attack.damage_type == DamageType.CUT:
-					self.sever(target_part)
-					sever_descriptor = f"The {self.name}'s {target_part.name} is [r]severed[w] by the attack!"
-					self.raise_event(Event(visual = sever_descriptor))
-					return damage
-				target_part.kill()
-				destroy_descriptor = f"The {self.name}'s {target_part.name} is [r]pulped[w] by the attack!"
-				self.raise_event(Event(visual = destroy_descriptor))
-				return damage
-			target_part.traits.append(PartFlag.CRIPPLED)
-			cripple_descriptor = f"The {self.name}'s {target_part.name} is [r]crippled[w] by the blow!"
-			self.raise_event(Event(visual = cripple_descriptor))
-		return damage
+		return combat.strike(attacker, self, attack)
+
+	# Highest 3d6 roll that dodges an attack, 0 if it can't dodge
+	def dodge_target(self, attacker):
+		return 0
+
+	# Called once for each attack or volley that hurt it
+	def bleed(self):
+		return
+
+	# Called once for each attack or volley that hit it
+	def check_death(self):
+		return
 
 	def can_be_picked_up(self, picker):
 		return True
@@ -318,10 +637,7 @@ class Entity:
 		target.position = self.global_position
 		target.container = None
 		self._contents.remove(target)
-		for part in self.root_part.get_part_list():
-			if part.held is target:
-				part.held = None
-				break
+		self.body.release(target)
 		return True
 
 	def insert(self, target):
@@ -333,62 +649,177 @@ class Entity:
 class EntityContainer:
 	def __init__(self):
 		self.contents = []
-		self.buckets = defaultdict(list)
+		self.index = SpatialIndex()
+		# position -> [entity], reading a position nothing is on gives ()
+		self.buckets = self.index.buckets
 		self._events = []
-		self.effects = []
+		# Effect -> time it expires at
+		self.effects = {}
+		self._effect_queue = []
 		self.tiles = None
+		self.time = 0
+		# Entity -> entities it can see, nearest first, for everything that
+		# perceives and was due at the start of the current tick
+		self.perception = {}
+		# Highest IQ of anything added, bounds how far away events can be heard.
+		# Raised whenever a contained entity's IQ goes up, never lowered
+		self.max_IQ = 0
+		# Heap of (wake time, ticket, entity). Rescheduling an entity pushes a new
+		# entry and hands it a new ticket, older entries for it are left in place
+		# and skipped once they reach the top
+		self.queue = []
+		self._tickets = count()
+		# Entities off the schedule until woken, like corpses and loose items
+		self.dormant = set()
 
 	def add_entity(self, *entities):
 		for e in entities:
 			self.contents.append(e)
+			delay = e.delay
 			e.observer = self
+			self.schedule(e, self.time + delay)
+			self.raise_hearing(getattr(e, "IQ", 0))
 			if pos := e.position:
-				self.buckets[pos].append(e)
-		self.sort_entities()
+				self.index.insert(e, pos)
+
+	def raise_hearing(self, IQ):
+		if IQ > self.max_IQ:
+			self.max_IQ = IQ
+
+	def schedule(self, entity, wake):
+		self.dormant.discard(entity)
+		if (store := Entity.STORE) is not None:
+			if entity._row is None:
+				store.attach(entity)
+			store.columns["active"][entity._row] = True
+		entity._wake = wake
+		entity._ticket = next(self._tickets)
+		heappush(self.queue, (wake, entity._ticket, entity))
+		# Drop stale entries once they outnumber the live ones
+		if len(self.queue) > 2 * len(self.contents) + 64:
+			self.queue = [entry for entry in self.queue if entry[1] == entry[2]._ticket]
+			heapify(self.queue)
+
+	def suspend(self, entity):
+		entity._ticket = None # Leaves its heap entries stale
+		self.dormant.add(entity)
+		if entity._row is not None:
+			Entity.STORE.release(entity)
+
+	def wake(self, entity, delay = 1):
+		if entity in self.dormant:
+			self.schedule(entity, self.time + delay)
+
+	# Entity due to act next, or None if nothing is scheduled
+	def peek(self):
+		queue = self.queue
+		while queue:
+			entry = queue[0]
+			if entry[1] == entry[2]._ticket:
+				return entry[2]
+			heappop(queue)
+		return None
 
 	def add_event(self, event):
 		self._events.append(event)
 		if event.position is None:
 			return
-		for e in self.contents:
+		# Only entities close enough to possibly hear it are told
+		radius = event.audible_radius(self.max_IQ)
+		for e in self.index.in_radius(event.position, radius):
 			e.process_event(event)
 
 	# TODO: Make insertions keep entities sorted by size
 	# TODO: Make sort preserving insertion utility function
 	def rebucket(self, entity, old, new):
-		if old:
-			self.buckets[old].remove(entity)
-		if new:
-			self.buckets[new].append(entity)
-
-	def sort_entities(self):
-		self.contents = sorted(self.contents, key = lambda x: x.delay)
+		self.index.move(entity, old, new)
+		if new is None:
+			self.perception = {}
 
+	# Runs the game until the player is due to act
 	def process(self):
-		self.sort_entities()
-		while self.contents[0].is_player == False or self.contents[0].delay > 0:
-			self.tick()
-
-	def tick(self):
-		for entity in self.contents:
-			entity.delay -= 1
-		while self.contents[0].delay <= 0 and self.contents[0].is_player == False:
-			self.contents[0].update()
-			self.sort_entities()
-		expired = []
-		for effect in self.effects:
-			effect.age += 1
-			if effect.age > effect.duration:
-				expired.append(effect)
-		for effect in expired:
-			self.effects.remove(effect)
+		while (e := self.peek()).is_player == False or e.delay > 0:
+			self.advance()
+
+	# Jumps the clock straight to the next tick where anything is due instead of
+	# stepping through the empty ones in between. Returns the time that passed
+	def advance(self):
+		elapsed = 1
+		if (e := self.peek()) is not None:
+			elapsed = max(1, math.ceil(e._wake) - self.time)
+		self.tick(elapsed)
+		return elapsed
+
+	def tick(self, elapsed = 1):
+		self.time += elapsed
+		if Entity.STORE is not None:
+			self.sweep()
+		self.perceive()
+		# Only entities that are due are touched. An update that doesn't set a new
+		# delay leaves the entity on top, so it acts again this tick as before
+		while (e := self.peek()) is not None and e.delay <= 0 and e.is_player == False:
+			e.update()
+		# Effects age with the clock, they're only looked at when they expire
+		queue = self._effect_queue
+		while queue and queue[0][0] < self.time:
+			del self.effects[heappop(queue)[2]]
+
+	def add_effect(self, effect):
+		expires = self.time - effect.age + effect.duration
+		self.effects[effect] = expires
+		heappush(self._effect_queue, (expires, next(self._tickets), effect))
+
+	# Suspends everything still scheduled that has died or been knocked out since
+	# it last acted, rather than waiting for each to find out in update()
+	def sweep(self):
+		store = Entity.STORE
+		awareness = store.view("awareness")
+		down = store.view("dead") | (awareness == AWARENESS_CODES[Awareness.UNCONSCIOUS])
+		# The player stays scheduled, process() waits on their turn
+		for e in store.select(store.view("active") & down & ~store.view("player")):
+			if e.observer is self:
+				self.suspend(e)
+
+	# Everything due to act this tick except the player. Only walks the part of
+	# the heap with wake times that have passed
+	def due(self):
+		queue = self.queue
+		found = []
+		pending = [0] if queue else []
+		while pending:
+			i = pending.pop()
+			wake, ticket, e = queue[i]
+			if wake > self.time:
+				continue
+			if ticket == e._ticket and not e.is_player:
+				found.append(e)
+			pending += [child for child in (2 * i + 1, 2 * i + 2) if child < len(queue)]
+		return found
+
+	# Works out in one pass what every perceiving entity due this tick can see.
+	# Each position is only looked at once however many are standing there, and
+	# they all share the same list, so it mustn't be modified. The lists are
+	# thrown away if anything in the container is picked up during the tick,
+	# leaving everyone still to act to look again
+	def perceive(self):
+		self.perception = {}
+		if self.tiles is None:
+			return
+		views = {}
+		for e in self.due():
+			if (position := e.position) is None or not e.perceives():
+				continue
+			if (seen := views.get(position)) is None:
+				# Same order as Actor.search_for_entities gives
+				occupied = self.index.occupied(self.tiles.visible_from(position))
+				occupied.sort(key = lambda p: util.manhattan_dist(position, p))
+				seen = [x for p in occupied for x in self.buckets[p]]
+				views[position] = seen
+			self.perception[e] = seen
 
 	def get_within_radius(self, e, radius = 1, exclude_self = True):
 		ex, ey = e.global_position
-		discovered = []
-		for x in range(ex - radius, ex + radius + 1):
-			for y in range(ey - radius, ey + radius + 1):
-				discovered += self.buckets[(x, y)]
+		discovered = self.index.in_rect(ex - radius, ey - radius, ex + radius, ey + radius)
 		if exclude_self and e in discovered:
 			discovered.remove(e)
 		return discovered
@@ -403,15 +834,18 @@ class EntityContainer:
 		for e in sorted(self.contents, key = lambda x: x.size):
 			if e.position is not None:
 				grid[e.position] = e.display_tile
-		for e in self.effects:
-			grid[e.position] = e.sample()
+		self.sample_effects(grid)
 		return grid
 
+	def sample_effects(self, grid):
+		for e, expires in self.effects.items():
+			e.age = e.duration - (expires - self.time)
+			grid[e.position] = e.sample()
+
 	def build_grid_with_visibility(self, visible):
 		grid = {}
 		for e in sorted(self.contents, key = lambda x: x.size):
 			if e.position in visible:
 				grid[e.position] = e.display_tile
-		for e in self.effects:
-			grid[e.position] = e.sample()
+		self.sample_effects(grid)
 		return grid
\ No newline at end of file
@@ -0,0 +1,91 @@
+from heapq import heappush, heappop
+import util
+
+# For each step direction, the index of the opposite one
+REVERSE = [util.MOORE_NEIGHBORHOOD.index((-dx, -dy)) for dx, dy in util.MOORE_NEIGHBORHOOD]
+
+# Dijkstra map towards a set of goal cells, flooding outwards from the goals
+# with the same movement costs the A* search uses. Each settled cell stores the
+# index into util.MOORE_NEIGHBORHOOD of the step to take from it.
+#
+# The flood is lazy: it only runs as far as it has to to settle the cells
+# actors have actually asked about, and then stops until someone further out
+# asks. It never leaves the goals' bounding box grown by radius, so a field
+# costs at most that area however large the map is. Cells outside it, or that
+# can't reach a goal, get no step and should be pathed to some other way.
+class FlowField:
+	def __init__(self, tiles, goals, radius = None):
+		self.tiles = tiles
+		self.goals = frozenset(goals)
+		if radius is None:
+			self.bounds = (0, 0, tiles.width - 1, tiles.height - 1)
+		else:
+			xs = [x for x, _ in self.goals]
+			ys = [y for _, y in self.goals]
+			self.bounds = (
+				max(0, min(xs) - radius), max(0, min(ys) - radius),
+				min(tiles.width - 1, max(xs) + radius), min(tiles.height - 1, max(ys) + radius))
+		# Settled cell -> index of the step to take from it, -1 for goals
+		self.direction = {}
+		self.distance = {}
+		self.frontier = []
+		for goal in self.goals:
+			self.distance[goal] = 0
+			heappush(self.frontier, (0, goal, -1))
+
+	# Carries on flooding until position is settled or there's nowhere left to
+	# go, returns whether a goal can be reached from position
+	def flood(self, position):
+		if position in self.direction:
+			return True
+		x0, y0, x1, y1 = self.bounds
+		if not (x0 <= position[0] <= x1 and y0 <= position[1] <= y1):
+			return False
+		cost = self.tiles.cost
+		entities = self.tiles.entities
+		buckets = entities.buckets if entities else {}
+		direction = self.direction
+		distance = self.distance
+		frontier = self.frontier
+		while frontier:
+			current_cost, current, step = heappop(frontier)
+			if current in direction or current_cost > distance[current]:
+				continue
+			direction[current] = step
+			cx, cy = current
+			for i, (dx, dy) in enumerate(util.MOORE_NEIGHBORHOOD):
+				x = cx + dx
+				y = cy + dy
+				if not (x0 <= x <= x1 and y0 <= y <= y1):
+					continue
+				node_cost = cost.item(y, x)
+				if node_cost < 0:
+					continue
+				if dx and dy:
+					node_cost = int(node_cost * 1.4) # Increase costs for diagonal movement
+				if crowd := buckets.get((x, y)):
+					node_cost += len(crowd) * 5 # Don't overcrowd
+				node_cost += current_cost
+				node = (x, y)
+				if node not in distance or node_cost < distance[node]:
+					distance[node] = node_cost
+					# Stepping back the way the flood came
+					heappush(frontier, (node_cost, node, REVERSE[i]))
+			if current == position:
+				return True
+		return False
+
+	def reaches(self, position):
+		return self.flood(tuple(position))
+
+	# Next cell to move into from position, None if position is a goal or can't
+	# reach one
+	def step_from(self, position):
+		position = tuple(position)
+		if not self.flood(position):
+			return None
+		i = self.direction[position]
+		if i < 0:
+			return None
+		dx, dy = util.MOORE_NEIGHBORHOOD[i]
+		return (position[0] + dx, position[1] + dy)
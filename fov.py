@@ -0,0 +1,191 @@
+from collections import deque, OrderedDict
+import util
+
+# Field of view engines. Each one takes an opacity grid indexed [y, x], an
+# origin and an optional maximum radius and returns a dictionary mapping every
+# visible position to how clearly it can be seen. Light starts at 1.0 and is
+# multiplied by (1 - opacity) for every cell it passes through, including the
+# origin. A cell is visible if the light reaching it is at least
+# MIN_VISIBILITY, so partially opaque cells like bushes dim what is behind them
+# and enough of them in a row block sight entirely.
+#
+# Engines also take an optional set, scanned, which they fill with every cell
+# whose opacity they looked at. The result depends on those cells alone, so it
+# stays valid for as long as none of them change.
+
+MIN_VISIBILITY = .1
+
+# Reference engine. Casts a Bresenham ray from the origin to every cell on the
+# edge of the map so each call costs O((w + h) * max(w, h)) regardless of
+# radius. Kept around to check the other engines against.
+def raycast(opacity, origin, radius = None, scanned = None):
+	height, width = opacity.shape
+	ox, oy = origin
+	visible_tiles = {}
+	targets = []
+	# Cast rays from origin to each tile on the outer edge
+	# ensuring all tiles are hit at least once
+	for i in range(0, width):
+		targets.append((i, 0))
+		targets.append((i, height - 1))
+	for i in range(0, height):
+		targets.append((0, i))
+		targets.append((width - 1, i))
+	for t in targets:
+		line = util.bresenham_line(ox, oy, *t)
+		visibility = 1.0
+		for x, y in line:
+			if visibility < MIN_VISIBILITY: break
+			if not (0 <= x < width and 0 <= y < height): break
+			if radius is not None and (x - ox) ** 2 + (y - oy) ** 2 > radius * radius: break
+			visible_tiles[(x, y)] = max(visible_tiles.get((x, y), 0), visibility)
+			visibility *= 1 - opacity.item(y, x)
+	# Every cell a ray reads is one it reveals
+	if scanned is not None:
+		scanned.update(visible_tiles)
+	return visible_tiles
+
+# Maps (depth, column) inside a quadrant to an (x, y) offset from the origin:
+# dx = col * xx + depth * xy, dy = col * yx + depth * yy
+QUADRANTS = (
+	(1, 0, 0, -1),	# North
+	(0, 1, 1, 0),	# East
+	(1, 0, 0, 1),	# South
+	(0, -1, 1, 0),	# West
+)
+
+# Symmetric recursive shadowcasting, after Albert Ford's formulation. Each
+# quadrant is scanned outwards row by row and every run of see-through cells
+# spawns a narrower row behind it, so only cells that can actually be seen are
+# ever touched. A cell is visible from the origin exactly when the origin is
+# visible from the cell. Slopes are kept as integer fractions to avoid
+# rounding trouble on the tie-breaking cases.
+#
+# To support partial opacity each cell inherits the light transmitted by its
+# parent, the cell one row closer on the line back to the origin, and cells
+# that transmit less than MIN_VISIBILITY are treated as walls by the scan.
+# Fully opaque and fully transparent cells give exactly plain shadowcasting.
+def shadowcast(opacity, origin, radius = None, scanned = None):
+	height, width = opacity.shape
+	ox, oy = origin
+	visible_tiles = {}
+	if not (0 <= ox < width and 0 <= oy < height):
+		return visible_tiles
+	visible_tiles[(ox, oy)] = 1.0
+	if scanned is not None:
+		scanned.add((ox, oy))
+	origin_light = 1 - opacity.item(oy, ox)
+	if origin_light < MIN_VISIBILITY:
+		return visible_tiles
+	max_depth = max(width, height) if radius is None else radius
+	radius_squared = None if radius is None else radius * radius
+
+	for xx, xy, yx, yy in QUADRANTS:
+		# Light leaving each scanned cell, keyed by (depth, column)
+		light = {(0, 0): origin_light}
+		# Rows are (depth, start slope numerator, denominator, end slope numerator, denominator)
+		# and are processed breadth first so every parent is lit before its children
+		rows = deque([(1, -1, 1, 1, 1)])
+		while rows:
+			depth, start_num, start_den, end_num, end_den = rows.popleft()
+			min_col = (2 * depth * start_num + start_den) // (2 * start_den)
+			max_col = -((end_den - 2 * depth * end_num) // (2 * end_den))
+			prev_wall = None
+			for col in range(min_col, max_col + 1):
+				dx = col * xx + depth * xy
+				dy = col * yx + depth * yy
+				x = ox + dx
+				y = oy + dy
+				incoming = 0
+				if 0 <= x < width and 0 <= y < height and \
+					(radius_squared is None or dx * dx + dy * dy <= radius_squared):
+					# The line back to the origin crosses the previous row between
+					# these two cells, take whichever lets more light through
+					near = col * (depth - 1)
+					incoming = max(light.get((depth - 1, near // depth), 0), light.get((depth - 1, -(-near // depth)), 0))
+				is_wall = True
+				if incoming >= MIN_VISIBILITY:
+					transmitted = incoming * (1 - opacity.item(y, x))
+					light[(depth, col)] = transmitted
+					is_wall = transmitted < MIN_VISIBILITY
+					# Walls are revealed if any part of them is in view, everything
+					# else only if its center is, which is what keeps this symmetric
+					if is_wall or (col * start_den >= depth * start_num and col * end_den <= depth * end_num):
+						visible_tiles[(x, y)] = max(visible_tiles.get((x, y), 0), incoming)
+				if prev_wall and not is_wall:
+					start_num, start_den = 2 * col - 1, 2 * depth
+				if prev_wall is False and is_wall and depth < max_depth:
+					rows.append((depth + 1, start_num, start_den, 2 * col - 1, 2 * depth))
+				prev_wall = is_wall
+			if prev_wall is False and depth < max_depth:
+				rows.append((depth + 1, start_num, start_den, end_num, end_den))
+		# Opacity is read exactly for the cells light reached, including ones
+		# that turned out not to be visible but still cast shadows
+		if scanned is not None:
+			scanned.update((ox + col * xx + depth * xy, oy + col * yx + depth * yy) for depth, col in light)
+
+	return visible_tiles
+
+ENGINES = {
+	'shadowcast': shadowcast,
+	'raycast': raycast,
+}
+
+# Least recently used store for FOV results. Entries are keyed on the origin,
+# radius and engine and stamped with the opacity version of the grid they were
+# computed from, so rebuilding the whole grid stales everything at once. Each
+# entry also keeps the set of cells the engine scanned to produce it, visible or
+# not, and a single changed cell only drops the entries that scanned it. A cell
+# that wasn't scanned can't change the result, so everything else stays valid.
+class FOVCache:
+	def __init__(self, size = 512):
+		self.size = size
+		self._entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, key, version):
+		entry = self._entries.get(key)
+		if entry is None or entry[0] != version:
+			if entry is not None:
+				del self._entries[key]
+			self.misses += 1
+			return None
+		self._entries.move_to_end(key)
+		self.hits += 1
+		return entry[1]
+
+	def put(self, key, version, result, scanned):
+		self._entries[key] = (version, result, scanned)
+		self._entries.move_to_end(key)
+		self.trim()
+
+	def trim(self):
+		while len(self._entries) > self.size:
+			self._entries.popitem(last = False)
+			self.evictions += 1
+
+	# Drops every cached view that scanned position
+	def invalidate(self, position):
+		stale = [key for key, entry in self._entries.items() if position in entry[2]]
+		for key in stale:
+			del self._entries[key]
+		self.invalidations += len(stale)
+
+	def clear(self):
+		self._entries.clear()
+
+	def stats(self):
+		return {
+			"size": len(self._entries),
+			"capacity": self.size,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"invalidations": self.invalidations,
+		}
\ No newline at end of file
@@ -46,11 +46,9 @@ if DEBUG:
 		((0, 0, 0),)
 	)
 	fluid_flow = TileFeature("Flowing liquid", -1, None, char_overwrite = True, symbol = flow_glyph)
-	for tile in tiles.contents:
-		if tiles.contents[tile].floor_material.state == State.LIQUID:
-			tiles.contents[tile].add_feature(copy.copy(fluid_flow))
-
-	tiles.construct_opacity_grid()
+	for tile in tiles.iter_tiles():
+		if tile.floor_material.state == State.LIQUID:
+			tile.add_feature(copy.copy(fluid_flow))
 
 UI = Interface()
 
@@ -115,7 +113,7 @@ def idle():
 			return UI.events.pop(0)
 		else:
 			for i in range(TICKS_PER_FRAME):
-				entities.tick()
+				entities.advance()
 			time.sleep(max(TICK_RATE - (time.time() - cur_time), 0))
 	return False
 
@@ -201,7 +199,7 @@ while event := idle():
 		target = None
 		while True:
 			target = (random.randrange(60), random.randrange(20))
-			if tiles.get_tile(*target).traversal_cost() >= 0:
+			if tiles.traversal_cost(*target) >= 0:
 				break
 		z = Actor.from_template("Zombie", target, template_dict["human"], template_dict["zombie"])
 		entities.add_entity(z)
@@ -212,7 +210,7 @@ while event := idle():
 			if key.symbol == 'space':
 				break
 			if key.symbol == '.':
-				entities.tick(tiles)
+				entities.tick()
 		UI.pop_widget()
 	elif sym == 'x':
 		examine()
\ No newline at end of file
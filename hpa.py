@@ -0,0 +1,252 @@
+from heapq import heappush, heappop
+import util
+
+# Hierarchical pathfinding (HPA*). The map is cut into square clusters and
+# every run of open cells along the border between two neighbouring clusters
+# gets one or two transition cells. Transition cells form an abstract graph:
+# cells facing each other across a border are linked directly and cells of the
+# same cluster are linked by their cheapest route inside it. Long routes are
+# planned over that graph and then refined into steps one short leg at a time,
+# so a search costs roughly the number of clusters crossed instead of the
+# area of the map.
+#
+# Borders are scanned up front, which is cheap, while the routes inside a
+# cluster are only worked out the first time a search passes through it.
+# When a cell's traversal cost changes only its own cluster, plus the
+# neighbours sharing a border it sits on, are thrown away and rebuilt.
+
+# Runs of open border cells at least this long get a transition at each end
+# instead of one in the middle
+WIDE_ENTRANCE = 6
+
+def step_cost(cost, x, y, diagonal):
+	c = cost.item(y, x)
+	if diagonal:
+		c = int(c * 1.4) # Increase costs for diagonal movement
+	return c
+
+def octile(a, b):
+	x_dist = abs(a[0] - b[0])
+	y_dist = abs(a[1] - b[1])
+	return int((x_dist + y_dist - (min(x_dist, y_dist) * 0.6)) * 10)
+
+class ClusterGraph:
+	def __init__(self, tiles, cluster_size = 16):
+		self.tiles = tiles
+		self.cluster_size = cluster_size
+		self.columns = -(-tiles.width // cluster_size)
+		self.rows = -(-tiles.height // cluster_size)
+		# (cluster, neighbour to the right or below) -> [(cell in cluster, cell in neighbour)]
+		self.transitions = {}
+		# cluster -> set of its transition cells
+		self.nodes = {}
+		# cluster -> {cell: {cell: cost}} for routes inside the cluster, built lazily
+		self.edges = {}
+		# cell -> {cell: cost} for links across borders
+		self.links = {}
+		for cx in range(self.columns):
+			for cy in range(self.rows):
+				self.nodes[(cx, cy)] = set()
+		for cx in range(self.columns):
+			for cy in range(self.rows):
+				if cx + 1 < self.columns:
+					self.build_border((cx, cy), (cx + 1, cy))
+				if cy + 1 < self.rows:
+					self.build_border((cx, cy), (cx, cy + 1))
+
+	def cluster_of(self, position):
+		return (position[0] // self.cluster_size, position[1] // self.cluster_size)
+
+	# (x0, y0, x1, y1) with x1 and y1 exclusive
+	def bounds(self, cluster):
+		x0 = cluster[0] * self.cluster_size
+		y0 = cluster[1] * self.cluster_size
+		return (x0, y0, min(x0 + self.cluster_size, self.tiles.width), min(y0 + self.cluster_size, self.tiles.height))
+
+	def passable(self, x, y):
+		return self.tiles.cost.item(y, x) >= 0
+
+	# Finds the transitions between cluster a and the cluster b to its right or
+	# below it, replacing whatever was there before
+	def build_border(self, a, b):
+		cost = self.tiles.cost
+		for cell_a, cell_b in self.transitions.pop((a, b), ()):
+			self.links.get(cell_a, {}).pop(cell_b, None)
+			self.links.get(cell_b, {}).pop(cell_a, None)
+
+		ax0, ay0, ax1, ay1 = self.bounds(a)
+		if b[0] != a[0]:
+			# Vertical border, walk down it
+			pairs = [((ax1 - 1, y), (ax1, y)) for y in range(ay0, ay1)]
+		else:
+			# Horizontal border, walk along it
+			pairs = [((x, ay1 - 1), (x, ay1)) for x in range(ax0, ax1)]
+
+		runs = []
+		run = []
+		for cell_a, cell_b in pairs:
+			if self.passable(*cell_a) and self.passable(*cell_b):
+				run.append((cell_a, cell_b))
+			elif run:
+				runs.append(run)
+				run = []
+		if run:
+			runs.append(run)
+
+		transitions = []
+		for run in runs:
+			if len(run) >= WIDE_ENTRANCE:
+				transitions += [run[0], run[-1]]
+			else:
+				transitions.append(run[len(run) // 2])
+		self.transitions[(a, b)] = transitions
+
+		for cell_a, cell_b in transitions:
+			self.links.setdefault(cell_a, {})[cell_b] = step_cost(cost, *cell_b, False)
+			self.links.setdefault(cell_b, {})[cell_a] = step_cost(cost, *cell_a, False)
+		for cluster in (a, b):
+			self.refresh_nodes(cluster)
+
+	def refresh_nodes(self, cluster):
+		cx, cy = cluster
+		nodes = set()
+		for key in (((cx - 1, cy), cluster), ((cx, cy - 1), cluster), (cluster, (cx + 1, cy)), (cluster, (cx, cy + 1))):
+			for cell_a, cell_b in self.transitions.get(key, ()):
+				nodes.add(cell_a if key[0] == cluster else cell_b)
+		self.nodes[cluster] = nodes
+		self.edges.pop(cluster, None)
+
+	# Called when the traversal cost of a cell changes
+	def mark_dirty(self, x, y):
+		cluster = self.cluster_of((x, y))
+		cx, cy = cluster
+		x0, y0, x1, y1 = self.bounds(cluster)
+		self.edges.pop(cluster, None)
+		if x == x0 and cx > 0:
+			self.build_border((cx - 1, cy), cluster)
+		if x == x1 - 1 and cx + 1 < self.columns:
+			self.build_border(cluster, (cx + 1, cy))
+		if y == y0 and cy > 0:
+			self.build_border((cx, cy - 1), cluster)
+		if y == y1 - 1 and cy + 1 < self.rows:
+			self.build_border(cluster, (cx, cy + 1))
+
+	# Dijkstra from source without leaving the given bounds. Works on a plain
+	# list copy of the cluster's costs, which is a lot quicker to index one
+	# cell at a time than the numpy grid. Stops early once every target is
+	# settled if targets are given
+	def flood(self, source, bounds, targets = None):
+		x0, y0, x1, y1 = bounds
+		width = x1 - x0
+		height = y1 - y0
+		local_cost = self.tiles.cost[y0:y1, x0:x1].tolist()
+		remaining = set(targets) if targets is not None else None
+		distance = {source: 0}
+		frontier = [(0, source)]
+		while frontier:
+			current_cost, current = heappop(frontier)
+			if current_cost > distance[current]:
+				continue
+			if remaining is not None:
+				remaining.discard(current)
+				if not remaining: break
+			lx = current[0] - x0
+			ly = current[1] - y0
+			for dx, dy in util.MOORE_NEIGHBORHOOD:
+				x = lx + dx
+				y = ly + dy
+				if not (0 <= x < width and 0 <= y < height):
+					continue
+				node_cost = local_cost[y][x]
+				if node_cost < 0:
+					continue
+				if dx and dy:
+					node_cost = int(node_cost * 1.4) # Increase costs for diagonal movement
+				node_cost += current_cost
+				node = (x + x0, y + y0)
+				if node not in distance or node_cost < distance[node]:
+					distance[node] = node_cost
+					heappush(frontier, (node_cost, node))
+		return distance
+
+	def cluster_edges(self, cluster):
+		edges = self.edges.get(cluster)
+		if edges is None:
+			edges = {}
+			bounds = self.bounds(cluster)
+			nodes = self.nodes[cluster]
+			for node in nodes:
+				distance = self.flood(node, bounds, nodes)
+				edges[node] = {other: distance[other] for other in nodes if other != node and other in distance}
+			self.edges[cluster] = edges
+		return edges
+
+	# Plans over the abstract graph and returns the cells to pass through from
+	# start to goal, or None if there is no route
+	def abstract_path(self, start, goal):
+		start_cluster = self.cluster_of(start)
+		goal_cluster = self.cluster_of(goal)
+		start_reach = self.flood(start, self.bounds(start_cluster))
+		start_edges = {node: start_reach[node] for node in self.nodes[start_cluster] if node in start_reach}
+		if start_cluster == goal_cluster and goal in start_reach:
+			start_edges[goal] = start_reach[goal]
+		# Start or goal may be transition cells themselves, with a link straight
+		# across the border
+		for node, edge_cost in self.links.get(start, {}).items():
+			if node not in start_edges or edge_cost < start_edges[node]:
+				start_edges[node] = edge_cost
+		goal_reach = self.flood(goal, self.bounds(goal_cluster))
+		goal_edges = {node: goal_reach[node] for node in self.nodes[goal_cluster] if node in goal_reach}
+		for node in self.links.get(goal, ()):
+			edge_cost = self.links[node][goal]
+			if node not in goal_edges or edge_cost < goal_edges[node]:
+				goal_edges[node] = edge_cost
+
+		frontier = [(0, 0, start)]
+		came_from = {start: None}
+		path_cost = {start: 0}
+		while frontier:
+			_, current_cost, current = heappop(frontier)
+			if current_cost > path_cost[current]:
+				continue
+			if current == goal:
+				path = []
+				while current is not None:
+					path.append(current)
+					current = came_from[current]
+				path.reverse()
+				return path
+
+			if current == start:
+				neighbors = start_edges.items()
+			else:
+				neighbors = list(self.cluster_edges(self.cluster_of(current)).get(current, {}).items())
+				neighbors += self.links.get(current, {}).items()
+				if current in goal_edges:
+					neighbors.append((goal, goal_edges[current]))
+			for node, edge_cost in neighbors:
+				node_cost = current_cost + edge_cost
+				if node not in path_cost or node_cost < path_cost[node]:
+					path_cost[node] = node_cost
+					came_from[node] = current
+					heappush(frontier, (node_cost + octile(node, goal), node_cost, node))
+		return None
+
+	# Full step by step path like TileContainer.heuristic returns, found by
+	# refining each leg of the abstract path with a short grid search
+	def find_path(self, start, goal):
+		start = tuple(start)
+		goal = tuple(goal)
+		if start == goal:
+			return []
+		waypoints = self.abstract_path(start, goal)
+		if waypoints is None:
+			return None
+		leg_budget = self.cluster_size * self.cluster_size * 4
+		path = []
+		for a, b in zip(waypoints, waypoints[1:]):
+			leg = self.tiles.heuristic(a, b, leg_budget)
+			if leg is None:
+				return None
+			path += leg
+		return path
@@ -1,6 +1,7 @@
 import json
 import os
 import tile
+import mapcache
 from structs import *
 from collections import ChainMap
 
@@ -33,7 +34,12 @@ default_tile = {
 	'ceil': 'air',
 }
 
-def load_map(materials, features, map_name):
+# Maps are compiled to a binary cache on first load and read back from it
+# while the map, its definitions, features and materials are unchanged
+def load_map(materials, features, map_name, use_cache = True):
+	if use_cache and (compiled := mapcache.load(map_name, materials, features)):
+		return compiled
+
 	with open(f"data/maps/{map_name}_defs.json") as defs_file:
 		tile_defs = json.load(defs_file)
 
@@ -41,27 +47,35 @@ def load_map(materials, features, map_name):
 		map_raw = map_file.read()
 
 	width = len(map_raw.partition('\n')[0])
-	height = map_raw.count('\n')
 	map_raw = map_raw.replace("\n", "")
+	height = len(map_raw) // width
 
-	tiles = tile.TileContainer({}, width, height)
+	# Every cell drawn with the same character shares one prototype tile
+	prototypes = {}
+	cells = []
 	entity_blueprint = {}
 	for z in range(0, len(map_raw)):
 		glyph = map_raw[z]
-		tile_template = ChainMap(tile_defs[glyph], default_tile)
-		new_tile = tile.Tile(
-			materials[tile_template["wall"]],
-			materials[tile_template["floor"]],
-			materials[tile_template["ceil"]]
-		)
-		if "features" in tile_template:
-			for feature in tile_template["features"]:
-				new_tile.add_feature(features[feature])
-		x = z % width
-		y = z // width
-		if "entity" in tile_template:
-			entity_blueprint[(x, y)] = tile_template['entity']
-		tiles.set_tile(x, y, new_tile)
+		if glyph not in prototypes:
+			tile_template = ChainMap(tile_defs[glyph], default_tile)
+			new_tile = tile.Tile(
+				materials[tile_template["wall"]],
+				materials[tile_template["floor"]],
+				materials[tile_template["ceil"]]
+			)
+			if "features" in tile_template:
+				for feature in tile_template["features"]:
+					new_tile.add_feature(features[feature])
+			prototypes[glyph] = new_tile
+		if "entity" in tile_defs[glyph]:
+			x = z % width
+			y = z // width
+			entity_blueprint[(x, y)] = tile_defs[glyph]['entity']
+		cells.append(prototypes[glyph])
+
+	tiles = tile.TileContainer.from_tiles(width, height, cells)
+	if use_cache:
+		mapcache.save(map_name, tiles, entity_blueprint, features)
 
 	return tiles, entity_blueprint
 
@@ -72,8 +86,11 @@ def load_templates():
 		with open(path) as file:
 			templates = json.load(file)
 
-		# Filtering strings into enums
-		for template in templates.values():
+		for name, template in templates.items():
+			# Chains of templates are compiled once and looked up by name, see
+			# Entity.compile_templates
+			template["name"] = name
+			# Filtering strings into enums
 			if "bodyplan" in template:
 				template["bodyplan"] = BodyType(template["bodyplan"])
 			if "melee_attacks" in template:
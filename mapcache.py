@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+import tile
+
+# Compiled maps. Parsing a map and its definitions and building every tile is
+# the bulk of startup, so the result of load_map is written out as a binary
+# file holding the material id grids, the derived opacity and cost grids, the
+# feature table and the entity blueprint. Later loads memory map the grids
+# straight out of the file while none of the source files have changed.
+#
+# Layout: MAGIC, a little endian (version, header length) pair and a JSON
+# header describing the sources, palettes and where each array lives. Arrays
+# follow the header, each aligned to ALIGNMENT bytes.
+
+CACHE_DIR = "data/maps/cache"
+MAGIC = b"ARENAMAP"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<II")
+ALIGNMENT = 64
+
+def source_paths(map_name):
+	return [
+		f"data/maps/{map_name}.map",
+		f"data/maps/{map_name}_defs.json",
+		"data/maps/tile_features.json",
+		"data/materials.json",
+	]
+
+def cache_path(map_name):
+	return f"{CACHE_DIR}/{map_name}.mapc"
+
+def file_digest(path):
+	with open(path, "rb") as f:
+		return hashlib.sha256(f.read()).hexdigest()
+
+def fingerprint(path):
+	stat = os.stat(path)
+	return [stat.st_mtime_ns, stat.st_size, file_digest(path)]
+
+# A source is unchanged if its mtime and size match, or failing that if its
+# contents still hash the same (e.g. it was touched or checked out again)
+def source_unchanged(path, recorded):
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return False
+	mtime, size, digest = recorded
+	if stat.st_mtime_ns == mtime and stat.st_size == size:
+		return True
+	return stat.st_size == size and file_digest(path) == digest
+
+def read_header(path):
+	with open(path, "rb") as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			return None
+		version, header_length = PREAMBLE.unpack(f.read(PREAMBLE.size))
+		if version != FORMAT_VERSION:
+			return None
+		return json.loads(f.read(header_length))
+
+# Returns (tiles, entity_blueprint) from the compiled map, or None if there is
+# no usable compiled copy. A compiled copy that can't be read is deleted, the
+# caller compiles the map again after parsing it
+def load(map_name, materials, features):
+	path = cache_path(map_name)
+	if not os.path.exists(path):
+		return None
+	try:
+		return read(path, materials, features)
+	except (OSError, ValueError, KeyError, IndexError, TypeError, struct.error):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+		return None
+
+def read(path, materials, features):
+	header = read_header(path)
+	if header is None:
+		return None
+	for source, recorded in header["sources"].items():
+		if not source_unchanged(source, recorded):
+			return None
+	if any(name not in materials for name in header["materials"][1:]) or \
+		any(name not in features for name in header["features"]):
+		return None
+
+	# Copy on write, runtime changes to the map never touch the file
+	arrays = {}
+	for name, (offset, dtype, shape) in header["arrays"].items():
+		if not shape[0]:
+			arrays[name] = np.zeros(shape, dtype = dtype)
+			continue
+		arrays[name] = np.memmap(path, dtype = dtype, mode = "c", offset = offset, shape = tuple(shape))
+
+	palette = [tile.VoidTile.VOID] + [materials[name] for name in header["materials"][1:]]
+	feature_table = [features[name] for name in header["features"]]
+	cell_features = {}
+	for cell, feature_id in zip(arrays["feature_cells"].tolist(), arrays["feature_ids"].tolist()):
+		cell_features.setdefault(cell, []).append(feature_table[feature_id])
+
+	tiles = tile.TileContainer.from_arrays(
+		palette, arrays["wall"], arrays["floor"], arrays["ceiling"],
+		cell_features, arrays["opacity"], arrays["cost"])
+	entity_blueprint = {(x, y): entity for x, y, entity in header["entities"]}
+	return tiles, entity_blueprint
+
+def save(map_name, tiles, entity_blueprint, features):
+	feature_names = {id(feature): name for name, feature in features.items()}
+	feature_table = []
+	feature_ids = {}
+	feature_cells = []
+	feature_entries = []
+	for y, x in zip(*np.nonzero(tiles.features != None)):
+		for feature in tiles.features[y, x]:
+			name = feature_names.get(id(feature))
+			if name is None:
+				return False # Not from the feature definitions, can't be compiled
+			if name not in feature_ids:
+				feature_ids[name] = len(feature_table)
+				feature_table.append(name)
+			feature_cells.append(y * tiles.width + x)
+			feature_entries.append(feature_ids[name])
+
+	arrays = {
+		"wall": tiles.wall,
+		"floor": tiles.floor,
+		"ceiling": tiles.ceiling,
+		"opacity": tiles.opacity,
+		"cost": tiles.cost,
+		"feature_cells": np.array(feature_cells, dtype = np.int32),
+		"feature_ids": np.array(feature_entries, dtype = np.uint16),
+	}
+	header = {
+		"sources": {path: fingerprint(path) for path in source_paths(map_name)},
+		"materials": [m.name for m in tiles.materials],
+		"features": feature_table,
+		"entities": [[x, y, entity] for (x, y), entity in entity_blueprint.items()],
+		"arrays": {},
+	}
+
+	# Offsets depend on the header length, so lay the arrays out until the
+	# header fits in front of them
+	data_start = 0
+	while True:
+		offset = data_start
+		for name, array in arrays.items():
+			header["arrays"][name] = [offset, array.dtype.str, list(array.shape)]
+			offset += array.nbytes
+			offset += -offset % ALIGNMENT
+		header_bytes = json.dumps(header).encode()
+		header_end = len(MAGIC) + PREAMBLE.size + len(header_bytes)
+		if header_end <= data_start: break
+		data_start = header_end + -header_end % ALIGNMENT
+
+	path = cache_path(map_name)
+	temp_path = path + ".tmp"
+	try:
+		os.makedirs(CACHE_DIR, exist_ok = True)
+		with open(temp_path, "wb") as f:
+			f.write(MAGIC)
+			f.write(PREAMBLE.pack(FORMAT_VERSION, len(header_bytes)))
+			f.write(header_bytes)
+			for name, array in arrays.items():
+				f.seek(header["arrays"][name][0])
+				f.write(np.ascontiguousarray(array).tobytes())
+		os.replace(temp_path, path)
+	except OSError:
+		return False
+	return True
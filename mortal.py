@@ -20,6 +20,8 @@ if len(sys.argv) > 1: map_name = sys.argv[1]
 tiles, entity_blueprint = loader.load_map(mat_dict, feature_dict, map_name)
 
 entities = EntityContainer()
+entities.tiles = tiles
+tiles.entities = entities
 
 for e in entity_blueprint:
 	template = entity_blueprint[e]
@@ -44,11 +46,9 @@ if DEBUG:
 		((0, 0, 0),)
 	)
 	fluid_flow = TileFeature("Flowing liquid", -1, None, char_overwrite = True, symbol = flow_glyph)
-	for tile in tiles.contents:
-		if tiles.contents[tile].floor_material.state == State.LIQUID:
-			tiles.contents[tile].add_feature(copy.copy(fluid_flow))
-
-	tiles.construct_opacity_grid()
+	for tile in tiles.iter_tiles():
+		if tile.floor_material.state == State.LIQUID:
+			tile.add_feature(copy.copy(fluid_flow))
 
 UI = Interface()
 
@@ -139,7 +139,7 @@ def pick_adjacent_entity(prompt):
 	return neighbors[target]
 
 def fire(template):
-	visible_entities = player.search_for_entities(tiles)
+	visible_entities = player.search_for_entities()
 	pointer = widget.Pointer(*player.position)
 	menu = widget.SingleSelectMenu(60, 0, 39, 12,
 		"Available Targets:", [i.name for i in visible_entities])
@@ -231,7 +231,7 @@ while event := poll():
 	elif key == 'x':
 		examine()
 	elif key in move_binds:
-		if not player.move(tiles, move_binds[key]): continue
+		if not player.move(move_binds[key]): continue
 	elif key == 's':
 		player.delay = 10
 	elif key == '.':
@@ -248,7 +248,7 @@ while event := poll():
 		target = (player.position[0] + direction[0], player.position[1] + direction[1])
 		e = entities.buckets[target]
 		if not e:
-			if tiles.contents[target].wall_material.state == State.SOLID:
+			if tiles.get_tile(*target).wall_material.state == State.SOLID:
 				player.emit_sound("Clang!", 3.0)
 			else:
 				shoutbox.add_shout("Whoosh!")
@@ -279,4 +279,4 @@ while event := poll():
 		attack_template = weapon.ranged_attacks[0]
 		fire(attack_template)
 
-	entities.process(tiles)
\ No newline at end of file
+	entities.process()
\ No newline at end of file
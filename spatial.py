@@ -0,0 +1,150 @@
+import heapq
+
+# Spatial index over the entities lying on the map. Entities are kept in two
+# tables: one keyed by exact position, which is what the game mostly asks
+# about, and one keyed by coarse square cells of cell_size tiles, which the
+# range queries walk so that their cost follows how many entities are nearby
+# rather than how many there are in total. Moving an entity touches one entry
+# in each table. Entities held by something else have no position and aren't
+# indexed.
+#
+# Reads never change the index. Looking up an empty position returns an empty
+# tuple and leaves the table as it was.
+
+class Buckets(dict):
+	def __missing__(self, key):
+		return ()
+
+class SpatialIndex:
+	def __init__(self, cell_size = 8):
+		self.cell_size = cell_size
+		# position -> [entity]
+		self.buckets = Buckets()
+		# coarse cell -> {entity: position}, insertion ordered
+		self.cells = {}
+
+	def __len__(self):
+		return sum(len(cell) for cell in self.cells.values())
+
+	def cell_of(self, position):
+		return (position[0] // self.cell_size, position[1] // self.cell_size)
+
+	def insert(self, entity, position):
+		if bucket := self.buckets.get(position):
+			bucket.append(entity)
+		else:
+			self.buckets[position] = [entity]
+		self.cells.setdefault(self.cell_of(position), {})[entity] = position
+
+	def remove(self, entity, position):
+		bucket = self.buckets[position]
+		bucket.remove(entity)
+		if not bucket:
+			del self.buckets[position]
+		cell = self.cell_of(position)
+		contents = self.cells[cell]
+		del contents[entity]
+		if not contents:
+			del self.cells[cell]
+
+	def move(self, entity, old, new):
+		if old:
+			self.remove(entity, old)
+		if new:
+			self.insert(entity, new)
+
+	# Contents of the occupied cells in the block between two corner cells. Huge
+	# blocks just go through every occupied cell instead
+	def cells_between(self, corner, opposite):
+		cx0, cy0 = corner
+		cx1, cy1 = opposite
+		cells = self.cells
+		if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(cells):
+			return [contents for (cx, cy), contents in cells.items() if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+		return [contents for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1) if (contents := cells.get((cx, cy)))]
+
+	# Which of the given positions something is standing on
+	def occupied(self, positions):
+		buckets = self.buckets
+		if len(positions) < len(buckets):
+			return [position for position in positions if position in buckets]
+		return [position for position in buckets if position in positions]
+
+	# Everything standing on one of the given positions
+	def at_positions(self, positions):
+		found = []
+		buckets = self.buckets
+		for position in self.occupied(positions):
+			found += buckets[position]
+		return found
+
+	# Everything with x0 <= x <= x1 and y0 <= y <= y1
+	def in_rect(self, x0, y0, x1, y1):
+		found = []
+		if (x1 - x0 + 1) * (y1 - y0 + 1) <= self.cell_size * self.cell_size:
+			buckets = self.buckets
+			for x in range(x0, x1 + 1):
+				for y in range(y0, y1 + 1):
+					if bucket := buckets.get((x, y)):
+						found += bucket
+			return found
+		for contents in self.cells_between(self.cell_of((x0, y0)), self.cell_of((x1, y1))):
+			for entity, (x, y) in contents.items():
+				if x0 <= x <= x1 and y0 <= y <= y1:
+					found.append(entity)
+		return found
+
+	# Everything within a straight line distance of radius
+	def in_radius(self, position, radius):
+		px, py = position
+		limit = radius * radius
+		r = int(radius)
+		found = []
+		for contents in self.cells_between(self.cell_of((px - r, py - r)), self.cell_of((px + r, py + r))):
+			for entity, (x, y) in contents.items():
+				if (x - px) ** 2 + (y - py) ** 2 <= limit:
+					found.append(entity)
+		return found
+
+	# The k entities closest to position, nearest first, optionally only those
+	# for which predicate is true. Walks square rings of cells outwards and
+	# stops once no unvisited cell can hold anything closer.
+	def nearest(self, position, k = 1, predicate = None):
+		if k <= 0:
+			return []
+		px, py = position
+		pcx, pcy = self.cell_of(position)
+		cells = self.cells
+		size = self.cell_size
+		best = [] # max heap of (-distance squared, order, entity)
+		order = 0
+		remaining = len(cells)
+		ring = 0
+		while remaining:
+			if ring == 0:
+				ring_cells = ((pcx, pcy),)
+			else:
+				ring_cells = [(pcx + dx, pcy - ring) for dx in range(-ring, ring + 1)]
+				ring_cells += [(pcx + dx, pcy + ring) for dx in range(-ring, ring + 1)]
+				ring_cells += [(pcx - ring, pcy + dy) for dy in range(-ring + 1, ring)]
+				ring_cells += [(pcx + ring, pcy + dy) for dy in range(-ring + 1, ring)]
+			for cell in ring_cells:
+				if (contents := cells.get(cell)) is None:
+					continue
+				remaining -= 1
+				for entity, (x, y) in contents.items():
+					if predicate is not None and not predicate(entity):
+						continue
+					entry = (-((x - px) ** 2 + (y - py) ** 2), -order, entity)
+					order += 1
+					if len(best) < k:
+						heapq.heappush(best, entry)
+					elif entry[:2] > best[0][:2]:
+						heapq.heapreplace(best, entry)
+			# Anything in the next ring out is at least this far away
+			reach = ring * size + min(px - pcx * size, py - pcy * size, (pcx + 1) * size - 1 - px, (pcy + 1) * size - 1 - py) + 1
+			if len(best) == k and -best[0][0] <= reach * reach:
+				break
+			ring += 1
+		best.sort(reverse = True)
+		return [entity for _, _, entity in best]
@@ -83,6 +83,8 @@ class Skill(Enum):
 	SPEAR = 'spear'
 
 class Event:
+	__slots__ = ("visual", "sound", "volume", "visual_priority", "position", "emitter")
+
 	# Volume is a logarithmic unit. An event with volume 0 can be heard automatically at a distance of 1 yard.
 	# Each +1 volume doubles this distance, each -1 halves it.
 	def __init__(self, visual = None, sound = None, volume = 0.0, visual_priority = True, position = None, emitter = None):
@@ -97,12 +99,21 @@ class Event:
 	def primary(self):
 		return self.visual if self.visual_priority else self.sound
 
+	# Distance from which a listener with the given IQ can no longer hear the
+	# event. Hearing takes a 3d6 roll of at most IQ + volume - log2(distance),
+	# rounded towards zero, and the lowest possible roll is 3. Padded slightly so
+	# rounding in log2 can't put a listener who hears it outside
+	def audible_radius(self, IQ):
+		return 2 ** (self.volume + IQ - 2 + 1e-6)
+
 	@property
 	def sound_glyph(self):
 		char = "!" # TODO: change character based on volume
 		return Glyph(char, (255, 255, 0))
 
 class Effect:
+	__slots__ = ("position", "characters", "color", "duration", "age")
+
 	def __init__(self, position, characters, color, duration):
 		self.position = position
 		self.characters = characters
@@ -115,12 +126,15 @@ class Effect:
 		return Glyph(character, self.color)
 
 class Attack:
-	def __init__(self, power, damage_type, target = None, weapon = None, flags = ()):
+	# An attack with no power rolls damage_dice d6 + damage_mod when it lands
+	def __init__(self, power, damage_type, target = None, weapon = None, flags = (), damage_dice = 0, damage_mod = 0):
 		self.power = power
 		self.damage_type = damage_type
 		self.target = target
 		self.weapon = weapon
 		self.flags = flags
+		self.damage_dice = damage_dice
+		self.damage_mod = damage_mod
 
 	@classmethod
 	def from_template(cls, template, target):
@@ -145,6 +159,8 @@ class Material:
 		self.smooth = smooth
 
 class Glyph:
+	__slots__ = ("character", "fg", "bg")
+
 	def __init__(self, character, fg = (255, 255, 255), bg = (0, 0, 0)):
 		self.character = character
 		self.fg = tuple(fg)
@@ -163,6 +179,8 @@ class Glyph:
 		return ord(x)
 
 class UnstableGlyph(Glyph):
+	__slots__ = ("characters", "fgs", "bgs")
+
 	def __init__(self, characters, fgs, bgs):
 		self.characters = characters
 		self.fgs = fgs
@@ -0,0 +1,54 @@
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import dice
+import loader
+import mapcache
+from entity import Entity, EntityContainer
+from actor import Actor
+
+# Data files are loaded relative to the repository root, compiled maps are
+# kept out of it
+@pytest.fixture
+def world(monkeypatch, tmp_path):
+	monkeypatch.chdir(ROOT)
+	monkeypatch.setattr(mapcache, "CACHE_DIR", str(tmp_path / "cache"))
+	materials = loader.load_materials()
+	Entity.DEFAULT_MAT = materials["flesh"]
+	return materials, loader.load_features(materials), loader.load_templates()
+
+@pytest.fixture
+def templates(world):
+	return world[2]
+
+# Plays out a seeded fight on the arena map and returns where everything ended
+# up and what happened
+@pytest.fixture
+def fight(world):
+	materials, features, templates = world
+	def run(seed):
+		dice.seed(seed)
+		tiles, blueprint = loader.load_map(materials, features, "arena", use_cache = False)
+		entities = EntityContainer()
+		entities.tiles = tiles
+		tiles.entities = entities
+		for position, spawn in blueprint.items():
+			names = spawn["templates"]
+			entities.add_entity(Actor.from_template(names[0], position, *[templates[name] for name in names]))
+		for i in range(20):
+			while True:
+				position = (random.randrange(tiles.width), random.randrange(tiles.height))
+				if tiles.traversal_cost(*position) >= 0:
+					break
+			entities.add_entity(Actor.from_template(f"Zombie {i}", position, templates["human"], templates["zombie"]))
+		for _ in range(200):
+			entities.tick()
+		return [(e.name, e.position, e.hp, e.dead, e.awareness) for e in entities.contents], \
+			[event.visual for event in entities.pop_events()]
+	return run
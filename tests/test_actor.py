@@ -0,0 +1,79 @@
+import dice
+import loader
+from entity import Entity, EntityContainer
+from actor import Actor
+from structs import Awareness, Event, PartFlag
+
+def test_pick_up_actor(templates):
+	dice.seed(0)
+	entities = EntityContainer()
+	picker = Actor.from_template("Picker", (5, 5), templates["human"])
+	target = Actor.from_template("Target", (5, 6), templates["human"])
+	entities.add_entity(picker, target)
+	picker.ST = target.ST + 5
+	target.awareness = Awareness.SLEEP # Can't dodge the grab
+	assert picker.get(target)
+	assert target.container is picker
+	assert [held for _, held in picker.get_held_entities()] == [target]
+
+def test_alert_actor_can_dodge_grab(templates):
+	entities = EntityContainer()
+	picker = Actor.from_template("Picker", (5, 5), templates["human"])
+	target = Actor.from_template("Target", (5, 6), templates["human"])
+	entities.add_entity(picker, target)
+	picker.ST = target.ST + 5
+	results = set()
+	for seed in range(50):
+		dice.seed(seed)
+		results.add(target.can_be_picked_up(picker))
+	assert results == {True, False}
+
+def test_severed_hand_drops_what_it_held(templates):
+	entities = EntityContainer()
+	actor = Actor.from_template("Actor", (5, 5), templates["human"])
+	axe = Entity.from_template("axe", None, templates["axe"])
+	entities.add_entity(actor, axe)
+	actor.ST = 20
+	assert actor.get(axe)
+	assert actor.get_weapon() is axe
+	hand = actor.root_part.get_parts_with_trait(PartFlag.GRASPER)[0]
+	actor.sever(hand.parent)
+	assert actor.get_weapon() is None
+	assert actor.body.holding == {}
+	assert axe.container is None
+	assert axe.position == actor.position
+	assert axe in entities.buckets[actor.position]
+
+def test_perception_skips_things_picked_up_since(world):
+	materials, features, templates = world
+	tiles, _ = loader.load_map(materials, features, "arena", use_cache = False)
+	entities = EntityContainer()
+	entities.tiles = tiles
+	tiles.entities = entities
+	actor = Actor.from_template("Actor", (5, 5), templates["human"])
+	other = Actor.from_template("Other", (5, 6), templates["human"])
+	axe = Entity.from_template("axe", (5, 7), templates["axe"])
+	entities.add_entity(actor, other, axe)
+	entities.perception[actor] = [other, axe]
+	other.ST = 20
+	assert other.get(axe)
+	seen = actor.perceived_entities()
+	assert other in seen
+	assert axe not in seen
+
+class Listener(Entity):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.heard = []
+
+	def process_event(self, event):
+		self.heard.append(event)
+
+def test_raised_IQ_widens_hearing(templates):
+	entities = EntityContainer()
+	listener = Listener.from_template("Listener", (5, 5))
+	entities.add_entity(listener)
+	listener.IQ = 10
+	event = Event("Bang", position = (5, 20))
+	entities.add_event(event)
+	assert listener.heard == [event]
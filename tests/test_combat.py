@@ -0,0 +1,63 @@
+import combat
+from actor import Actor
+from entity import EntityContainer
+from structs import DamageType, PartFlag
+
+def test_multiplier_table():
+	def multiplier(damage_type, cuttable, tolerant):
+		return combat.MULTIPLIERS[combat.DAMAGE_TYPE_CODES[damage_type], int(cuttable), int(tolerant)]
+	assert multiplier(DamageType.CUT, True, False) == 2
+	assert multiplier(DamageType.CUT, False, True) == 1.5
+	assert multiplier(DamageType.PIERCE_SMALL, False, False) == .5
+	assert multiplier(DamageType.PIERCE_SMALL, False, True) == .2
+	assert multiplier(DamageType.PIERCE, False, True) == .33
+	assert multiplier(DamageType.PIERCE_LARGE, True, False) == 1.5
+	assert multiplier(DamageType.IMPALE, False, False) == 2
+	assert multiplier(DamageType.PIERCE_HUGE, False, True) == 1
+	assert multiplier(DamageType.BASH, True, True) == 1
+	for damage_type in DamageType:
+		for cuttable in (False, True):
+			for tolerant in (False, True):
+				assert multiplier(damage_type, cuttable, tolerant) == \
+					combat.damage_multiplier(damage_type, cuttable, tolerant)
+
+# Writes down side effects instead of acting on them
+class Dummy(Actor):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.log = []
+
+	def raise_event(self, event):
+		self.log.append(event.visual)
+
+	def bleed(self):
+		self.log.append("bleed")
+
+	def check_death(self):
+		self.log.append("check death")
+
+def test_aftermath_order(templates):
+	entities = EntityContainer()
+	dummy = Dummy.from_template("Dummy", (5, 5), templates["human"])
+	entities.add_entity(dummy)
+	names = list(dummy.body.plan.names)
+	part = names.index
+	injuries = {
+		(dummy, part("Left leg")): (1, DamageType.BASH),
+		(dummy, part("Right arm")): (2, DamageType.CUT),
+		(dummy, part("Left arm")): (2, DamageType.BASH),
+		# Came off with the arm before its own injury is looked at
+		(dummy, part("Right hand")): (1, DamageType.CUT),
+	}
+	combat.aftermath(injuries, [dummy], [dummy])
+	assert dummy.log == [
+		"The Dummy's Left leg is [r]crippled[w] by the blow!",
+		"The Dummy's Right arm is [r]severed[w] by the attack!",
+		"The Dummy's Left arm is [r]pulped[w] by the attack!",
+		"bleed",
+		"check death",
+	]
+	assert dummy.body.traits[part("Left leg")] & combat.TRAIT_BITS[PartFlag.CRIPPLED]
+	assert not dummy.body.attached[part("Right arm")]
+	assert not dummy.body.attached[part("Right hand")]
+	assert not dummy.body.attached[part("Left arm")]
@@ -0,0 +1,11 @@
+import dice
+
+def test_seeded_runs_match(fight):
+	first = fight(1234)
+	assert first == fight(1234)
+	assert first != fight(4321)
+
+def test_no_dice_rolls_the_modifier():
+	dice.seed(0)
+	assert dice.roll(0, 6, 3) == 3
+	assert dice.roll(-1, 6, 2) == 2
@@ -0,0 +1,55 @@
+from entity import Entity, EntityContainer, ComponentStore, use_store
+from structs import Effect
+
+# Acts on a script of delays, None leaves the delay as it is. Suspends itself
+# once the script runs out
+class Scripted(Entity):
+	def __init__(self, name, delay, script, log):
+		super().__init__(name, (0, 0))
+		self.delay = delay
+		self.script = list(script)
+		self.log = log
+
+	def update(self):
+		self.log.append((self.name, self.observer.time))
+		if not self.script:
+			self.suspend()
+		elif (delay := self.script.pop(0)) is not None:
+			self.delay = delay
+
+def test_entities_act_on_the_ticks_they_are_due():
+	log = []
+	entities = EntityContainer()
+	entities.add_entity(
+		Scripted("A", 2, [3, 2.5], log),
+		Scripted("B", 1, [None, 4, 10], log))
+	jumps = [entities.advance() for _ in range(5)]
+	assert jumps == [1, 1, 3, 3, 7]
+	assert entities.time == 15
+	# B acts twice at 1 since its first update sets no delay, a fractional wake
+	# time acts on the tick after it, and ties go to whoever was scheduled first
+	assert log == [("B", 1), ("B", 1), ("A", 2), ("B", 5), ("A", 5), ("A", 8), ("B", 15)]
+	assert entities.peek() is None
+
+def test_effects_expire_across_clock_jumps():
+	entities = EntityContainer()
+	entities.add_entity(Scripted("A", 50, [], []))
+	smoke = Effect((1, 1), "*", (255, 255, 255), 3)
+	fire = Effect((2, 2), "^", (255, 0, 0), 100)
+	entities.add_effect(smoke)
+	entities.add_effect(fire)
+	assert entities.advance() == 50
+	assert smoke not in entities.effects
+	assert fire in entities.effects
+
+# The store only changes where the numbers are kept, fights have to come out
+# exactly the same with it
+def test_store_runs_match(fight):
+	plain = [fight(seed) for seed in (1, 2, 3)]
+	store = ComponentStore()
+	use_store(store)
+	try:
+		assert [fight(seed) for seed in (1, 2, 3)] == plain
+	finally:
+		use_store(None)
+	assert store.size > 0
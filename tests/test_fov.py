@@ -0,0 +1,56 @@
+import random
+
+import numpy as np
+
+import fov
+import loader
+import tile
+
+def test_shadowcast_is_symmetric():
+	rng = random.Random(0)
+	opacity = np.array([[float(rng.random() < 0.3) for _ in range(30)] for _ in range(30)])
+	floor = [(x, y) for y in range(30) for x in range(30) if opacity[y, x] == 0]
+	views = {cell: fov.shadowcast(opacity, cell) for cell in floor}
+	for a in floor:
+		for b in floor:
+			assert (b in views[a]) == (a in views[b])
+
+def test_radius_cuts_off_sight():
+	opacity = np.zeros((41, 41))
+	visible = fov.shadowcast(opacity, (20, 20), 7)
+	assert set(visible) == {(x, y) for y in range(41) for x in range(41)
+		if (x - 20) ** 2 + (y - 20) ** 2 <= 49}
+
+# Each partially opaque cell dims everything behind it until the light left
+# falls under MIN_VISIBILITY
+def test_partial_opacity_dims_sight():
+	opacity = np.zeros((3, 10))
+	opacity[:, 1:] = .5
+	visible = fov.shadowcast(opacity, (0, 1))
+	assert [visible.get((x, 1)) for x in range(6)] == [1.0, 1.0, .5, .25, .125, None]
+
+def test_sight_radius_bounds_default_views(world):
+	materials, _, _ = world
+	air = np.ones((100, 100), dtype = np.uint16)
+	tiles = tile.TileContainer.from_arrays([tile.VoidTile.VOID, materials["air"]], air, air, air)
+	tiles.sight_radius = 10
+	assert max(abs(x - 50) for x, _ in tiles.visible_from((50, 50))) == 10
+	tiles.sight_radius = None
+	assert len(tiles.visible_from((50, 50))) == 100 * 100
+
+# Smoke only drops the cached views that scanned the cells it lands on, the
+# ones left have to match views computed from scratch
+def test_cached_views_follow_smoke(world):
+	materials, features, _ = world
+	tiles, _ = loader.load_map(materials, features, "bunker", use_cache = False)
+	rng = random.Random(0)
+	origins = [(x, y) for y in range(tiles.height) for x in range(tiles.width) if tiles.opacity[y, x] == 0]
+	origins = rng.sample(origins, 40)
+	for origin in origins:
+		tiles.visible_from(origin)
+	smoke = tile.TileFeature("smoke", 1, visibility = .4)
+	for _ in range(10):
+		tiles.add_feature(rng.randrange(tiles.width), rng.randrange(tiles.height), smoke)
+		for origin in origins:
+			assert tiles.visible_from(origin) == fov.shadowcast(tiles.opacity, origin, tiles.sight_radius)
+	assert tiles.fov_cache.hits
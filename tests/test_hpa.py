@@ -0,0 +1,58 @@
+import random
+
+import numpy as np
+
+import tile
+import util
+
+def path_cost(tiles, start, path):
+	total = 0
+	for a, b in zip([start] + path, path):
+		assert max(abs(a[0] - b[0]), abs(a[1] - b[1])) == 1
+		cost = tiles.traversal_cost(*b)
+		assert cost >= 0
+		total += int(cost * 1.4) if util.is_diag((b[0] - a[0], b[1] - a[1])) else cost
+	return total
+
+def open_cell(tiles, rng):
+	while True:
+		cell = (rng.randrange(tiles.width), rng.randrange(tiles.height))
+		if tiles.traversal_cost(*cell) >= 0:
+			return cell
+
+# Routes over the cluster hierarchy against flat A* on the same map, which
+# always finds the cheapest path. Only trips long enough for find_path to hand
+# them to the hierarchy are compared
+def check_routes(tiles, rng, trips):
+	for _ in range(trips):
+		start = open_cell(tiles, rng)
+		goal = open_cell(tiles, rng)
+		if util.manhattan_dist(start, goal) <= tiles.CLUSTER_SIZE:
+			continue
+		flat = tiles.heuristic(start, goal)
+		routed = tiles.hierarchy.find_path(start, goal)
+		assert (routed is None) == (flat is None)
+		if flat is None:
+			continue
+		assert routed[-1] == goal
+		assert path_cost(tiles, start, routed) <= path_cost(tiles, start, flat) * 1.1
+
+def test_hierarchy_matches_flat_search(world):
+	materials, _, _ = world
+	rng = random.Random(0)
+	air, wood = materials["air"], materials["wood"]
+	size = 160
+	walls = np.array([rng.random() < 0.25 for _ in range(size * size)]).reshape(size, size)
+	palette = [tile.VoidTile.VOID, air, wood]
+	wall = np.where(walls, 2, 1).astype(np.uint16)
+	floor = np.ones((size, size), dtype = np.uint16)
+	tiles = tile.TileContainer.from_arrays(palette, wall, floor, floor.copy())
+	check_routes(tiles, rng, 20)
+
+	# Edits only rebuild the clusters they touch, routes have to keep up
+	for _ in range(300):
+		x, y = rng.randrange(size), rng.randrange(size)
+		material = air if tiles.traversal_cost(x, y) < 0 else wood
+		tiles.set_tile(x, y, tile.Tile(material, air, air))
+	assert tiles._hierarchy is not None
+	check_routes(tiles, rng, 20)
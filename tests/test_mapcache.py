@@ -0,0 +1,71 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import loader
+import mapcache
+
+# A copy of the data files to edit, with compiled maps written next to it
+@pytest.fixture
+def sources(world, tmp_path, monkeypatch):
+	shutil.copytree("data", tmp_path / "data")
+	monkeypatch.chdir(tmp_path)
+	materials, features, _ = world
+	return materials, features
+
+def cell_features(tiles):
+	return {(x, y): [feature.name for feature in tiles.features[y, x]]
+		for y, x in zip(*np.nonzero(tiles.features != None))}
+
+def test_compiled_map_matches_parsed(sources):
+	materials, features = sources
+	parsed, blueprint = loader.load_map(materials, features, "bunker")
+	compiled, compiled_blueprint = mapcache.load("bunker", materials, features)
+	for name in ("wall", "floor", "ceiling"):
+		assert [parsed.materials[i] for i in getattr(parsed, name).flat] == \
+			[compiled.materials[i] for i in getattr(compiled, name).flat]
+	assert np.array_equal(parsed.opacity, compiled.opacity)
+	assert np.array_equal(parsed.cost, compiled.cost)
+	assert cell_features(compiled) == cell_features(parsed)
+	assert cell_features(compiled)
+	assert compiled_blueprint == blueprint
+
+def test_edited_map_is_parsed_again(sources):
+	materials, features = sources
+	tiles, _ = loader.load_map(materials, features, "bunker")
+	path = "data/maps/bunker.map"
+	with open(path) as f:
+		rows = f.read().split("\n")
+	rows[1] = rows[1][0] + "X" + rows[1][2:]
+	with open(path, "w") as f:
+		f.write("\n".join(rows))
+	assert mapcache.load("bunker", materials, features) is None
+	edited, _ = loader.load_map(materials, features, "bunker")
+	assert edited.materials[edited.wall[1, 1]].name == "metal"
+	assert tiles.materials[tiles.wall[1, 1]].name != "metal"
+
+def test_truncated_cache_is_deleted(sources):
+	materials, features = sources
+	loader.load_map(materials, features, "bunker")
+	path = mapcache.cache_path("bunker")
+	with open(path, "r+b") as f:
+		f.truncate(os.path.getsize(path) // 2)
+	assert mapcache.load("bunker", materials, features) is None
+	assert not os.path.exists(path)
+
+def test_runtime_edits_stay_out_of_the_cache(sources):
+	materials, features = sources
+	loader.load_map(materials, features, "bunker")
+	path = mapcache.cache_path("bunker")
+	with open(path, "rb") as f:
+		before = f.read()
+	tiles, _ = mapcache.load("bunker", materials, features)
+	wall = tiles.get_tile(0, 0).copy()
+	tiles.set_tile(1, 1, wall)
+	assert tiles.get_tile(1, 1).wall_material is wall.wall_material
+	with open(path, "rb") as f:
+		assert f.read() == before
+	reloaded, _ = mapcache.load("bunker", materials, features)
+	assert reloaded.get_tile(1, 1).wall_material is not wall.wall_material
@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+from spatial import SpatialIndex
+
+class Thing:
+	def __init__(self, tag):
+		self.tag = tag
+
+def distance_squared(a, b):
+	return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2
+
+# Queries checked against scanning every entity, with entities moved around in
+# between so the coarse cells empty and fill again
+@pytest.mark.parametrize("cell_size", [1, 3, 8, 16])
+def test_queries_match_brute_force(cell_size):
+	rng = random.Random(cell_size)
+	index = SpatialIndex(cell_size)
+	positions = {}
+	def place():
+		return (rng.randrange(60), rng.randrange(40))
+	for i in range(150):
+		thing = Thing(i % 3)
+		positions[thing] = place()
+		index.insert(thing, positions[thing])
+
+	for _ in range(100):
+		for thing in rng.sample(list(positions), 10):
+			new = place()
+			index.move(thing, positions[thing], new)
+			positions[thing] = new
+		assert len(index) == len(positions)
+
+		x0, y0 = place()
+		x1, y1 = x0 + rng.randrange(30), y0 + rng.randrange(30)
+		assert set(index.in_rect(x0, y0, x1, y1)) == \
+			{t for t, (x, y) in positions.items() if x0 <= x <= x1 and y0 <= y <= y1}
+
+		center = place()
+		radius = rng.uniform(0, 25)
+		assert set(index.in_radius(center, radius)) == \
+			{t for t, p in positions.items() if distance_squared(p, center) <= radius * radius}
+
+		k = rng.randrange(1, 12)
+		tag = rng.randrange(3)
+		found = index.nearest(center, k, lambda t: t.tag == tag)
+		candidates = sorted(distance_squared(p, center) for t, p in positions.items() if t.tag == tag)
+		assert len(set(found)) == len(found)
+		assert all(t.tag == tag for t in found)
+		assert [distance_squared(positions[t], center) for t in found] == candidates[:k]
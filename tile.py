@@ -1,9 +1,23 @@
-from functools import cache
 from structs import *
-import tilemappings
+from heapq import heappush, heappop
+import numpy as np
+import fov
+from flowfield import FlowField
+from hpa import ClusterGraph
 import util
 
+# Movement point cost of moving through a cell made of the given wall
+# material, before tile features are taken into account. Negative is impassable
+def material_cost(material):
+	if material.state == State.GAS:
+		return 10
+	elif material.state == State.LIQUID:
+		return 30
+	return -1
+
 class Tile:
+	__slots__ = ("wall_material", "floor_material", "ceiling_material", "_features")
+
 	def __init__(self, wall_material, floor_material, ceiling_material):
 		self.wall_material = wall_material
 		self.floor_material = floor_material
@@ -32,11 +46,7 @@ class Tile:
 
 	# Movement point cost of moving through the tile
 	def traversal_cost(self, flyer = False):
-		cost = -1
-		if self.wall_material.state == State.GAS:
-			cost = 10
-		elif self.wall_material.state == State.LIQUID:
-			cost = 30
+		cost = material_cost(self.wall_material)
 		for feature in self._features:
 			cost *= feature.walkability
 		return cost
@@ -54,6 +64,7 @@ class Tile:
 		return False
 
 class VoidTile(Tile):
+	__slots__ = ()
 	VOID = Material("void", State.VOID, 0, 0, 1, '?', (0, 0, 0), (128, 0, 128), (128, 0, 128))
 
 	def __init__(self):
@@ -62,13 +73,54 @@ class VoidTile(Tile):
 		self.ceiling_material = VoidTile.VOID
 		self._features = []
 
-	def traversal_cost(self):
+	def traversal_cost(self, flyer = False):
 		return -1
 
 	def is_void(self):
 		return True
 
+# Lightweight handle to a single cell of a TileContainer. Everything is read
+# from the container's arrays on access so views are cheap to create and never
+# go stale. Use copy() to get a detached Tile.
+class TileView(Tile):
+	__slots__ = ("_container", "x", "y")
+
+	def __init__(self, container, x, y):
+		self._container = container
+		self.x = x
+		self.y = y
+
+	@property
+	def wall_material(self):
+		return self._container.materials[self._container.wall.item(self.y, self.x)]
+
+	@property
+	def floor_material(self):
+		return self._container.materials[self._container.floor.item(self.y, self.x)]
+
+	@property
+	def ceiling_material(self):
+		return self._container.materials[self._container.ceiling.item(self.y, self.x)]
+
+	@property
+	def _features(self):
+		return self._container.features[self.y, self.x] or ()
+
+	def add_feature(self, feature):
+		self._container.add_feature(self.x, self.y, feature)
+
+	def traversal_cost(self, flyer = False):
+		return self._container.cost.item(self.y, self.x)
+
+	def copy(self):
+		newTile = Tile(self.wall_material, self.floor_material, self.ceiling_material)
+		newTile._features = list(self._features)
+		return newTile
+
 class TileFeature:
+	__slots__ = ("name", "z_index", "material", "fg_overwrite", "bg_overwrite", "char_overwrite",
+		"symbol", "walkability", "visibility", "flags")
+
 	def __init__(self, name, z_index, material = None, fg_overwrite = False, bg_overwrite = False,
 		char_overwrite = False, symbol = None, walkability = 1.0, visibility = 1.0, flags = ()):
 		self.name = name
@@ -86,38 +138,166 @@ class TileFeature:
 		tag = util.build_tag(self.symbol.fg, self.symbol.bg)
 		return tag + self.name
 
+# Dense grid of tiles. Materials are interned into a palette and each cell only
+# stores small integer ids for its wall, floor and ceiling, all in arrays
+# indexed by [y, x]. Opacity and traversal cost are derived per cell from the
+# materials and features so hot code never has to touch a Tile object.
 class TileContainer:
-	def __init__(self, contents, width, height):
-		self.contents = contents
+	FOV_CACHE_SIZE = 512
+	# How far sight reaches by default. Views on big maps only scan this far
+	# around the viewer instead of the whole map
+	SIGHT_RADIUS = 64
+	# How many searches towards the same goal in one tick before a shared flow
+	# field is built for it instead, at least. Raised on maps where a field's
+	# flood can cover more cells than several searches would, see __init__
+	FLOW_FIELD_THRESHOLD = 3
+	# How far from its goal a flow field floods at most, actors further away
+	# search on their own
+	FLOW_FIELD_RADIUS = 32
+	# Rough number of cells a single search expands
+	SEARCH_CELLS = 1024
+	# Maps with at least this many cells plan long routes over a cluster
+	# hierarchy instead of searching the whole grid
+	HIERARCHY_THRESHOLD = 128 * 128
+	CLUSTER_SIZE = 16
+
+	def __init__(self, width, height, fov_cache_size = FOV_CACHE_SIZE):
 		self.width = width
 		self.height = height
 		self.voidtile = VoidTile()
+		self.materials = []
+		self.material_ids = {}
+		self.material_id(VoidTile.VOID)
+		self.wall = np.zeros((height, width), dtype = np.uint16)
+		self.floor = np.zeros((height, width), dtype = np.uint16)
+		self.ceiling = np.zeros((height, width), dtype = np.uint16)
+		# Sparse: None for featureless cells, otherwise a list sorted by z_index
+		self.features = np.full((height, width), None, dtype = object)
+		self.fov_engine = 'shadowcast'
+		# None lets sight reach across the whole map
+		self.sight_radius = self.SIGHT_RADIUS
+		self.fov_cache = fov.FOVCache(fov_cache_size)
+		# Bumped whenever the whole opacity grid is rebuilt, stales every cached FOV
+		self.opacity_version = 0
+		# Bumped whenever any traversal cost changes
+		self.cost_version = 0
+		self.flow_fields = {}
+		self.flow_demand = {}
+		flood_cells = min(width * height, (2 * self.FLOW_FIELD_RADIUS + 1) ** 2)
+		self.flow_field_threshold = max(self.FLOW_FIELD_THRESHOLD, flood_cells // self.SEARCH_CELLS)
+		self.flow_stamp = None
+		self._hierarchy = None
 		self.construct_opacity_grid()
 		self.entities = None
 
+	# Builds a container from a row-major sequence of tiles in one pass. Tiles
+	# may be shared between cells, each distinct tile is only examined once and
+	# opacity and cost are derived a single time at the end
+	@classmethod
+	def from_tiles(cls, width, height, tiles, **kwargs):
+		container = cls(width, height, **kwargs)
+		prototypes = []
+		prototype_ids = {}
+		cells = []
+		for tile in tiles:
+			i = prototype_ids.get(id(tile))
+			if i is None:
+				i = prototype_ids[id(tile)] = len(prototypes)
+				prototypes.append(tile)
+			cells.append(i)
+		cells = np.array(cells, dtype = np.int32).reshape(height, width)
+
+		for name in ("wall", "floor", "ceiling"):
+			ids = np.array([container.material_id(getattr(t, name + "_material")) for t in prototypes], dtype = np.uint16)
+			setattr(container, name, ids[cells])
+		for i, prototype in enumerate(prototypes):
+			if not prototype.features: continue
+			for y, x in zip(*np.nonzero(cells == i)):
+				container.features[y, x] = list(prototype.features)
+
+		container.construct_opacity_grid()
+		return container
+
+	# Wraps existing grids, such as ones memory mapped from a compiled map.
+	# features maps flat cell indices (y * width + x) to feature lists. If the
+	# derived opacity and cost grids aren't supplied they are rebuilt
+	@classmethod
+	def from_arrays(cls, materials, wall, floor, ceiling, features = None, opacity = None, cost = None, **kwargs):
+		height, width = wall.shape
+		container = cls(width, height, **kwargs)
+		for material in materials:
+			container.material_id(material)
+		container.wall = wall
+		container.floor = floor
+		container.ceiling = ceiling
+		for cell, cell_features in (features or {}).items():
+			container.features[cell // width, cell % width] = list(cell_features)
+		if opacity is None or cost is None:
+			container.construct_opacity_grid()
+		else:
+			container.opacity = opacity
+			container.cost = cost
+			container.opacity_version += 1
+		return container
+
+	# Returns the palette index of a material, adding it if it's new
+	def material_id(self, material):
+		if (i := self.material_ids.get(material)) is not None:
+			return i
+		i = len(self.materials)
+		self.materials.append(material)
+		self.material_ids[material] = i
+		self._material_opacity = np.array([m.opacity for m in self.materials], dtype = np.float64)
+		self._material_cost = np.array([material_cost(m) for m in self.materials], dtype = np.float64)
+		return i
+
+	# Rebuilds the derived opacity and cost grids from scratch
 	def construct_opacity_grid(self):
-		self.opacity_grid = self.map(tilemappings.opacity)
-
-	@cache
-	def visible_from(self, position):
-		visible_tiles = {}
-		targets = []
-		# Cast rays from origin to each tile on the outer edge
-		# ensuring all tiles are hit at least once
-		for i in range(0, self.width):
-			targets.append((i, 0))
-			targets.append((i, self.height))
-		for i in range(0, self.height):
-			targets.append((0, i))
-			targets.append((self.width, i))
-		for t in targets:
-			line = util.bresenham_line(*position, *t)
-			visibility = 1.0
-			for point in line:
-				if visibility < .1: break
-				visible_tiles[point] = max(visible_tiles.get(point, 0), visibility)
-				visibility *= 1 - self.opacity_grid.get(point, 0.0)
-		return visible_tiles
+		self.opacity_version += 1
+		self.cost_version += 1
+		self._hierarchy = None
+		self.opacity = self._material_opacity[self.wall]
+		self.cost = self._material_cost[self.wall]
+		for y, x in zip(*np.nonzero(self.features != None)):
+			self.derive_cell(int(x), int(y))
+
+	# Recomputes opacity and traversal cost for a single cell
+	def derive_cell(self, x, y):
+		wall = self.materials[self.wall.item(y, x)]
+		opacity = wall.opacity
+		cost = material_cost(wall)
+		for feature in self.features[y, x] or ():
+			opacity = max(opacity, 1 - feature.visibility)
+			cost *= feature.walkability
+		self.opacity[y, x] = opacity
+		self.cost[y, x] = cost
+
+	# Rederives a single cell after it changes at runtime, only throwing away
+	# the cached views that scanned it if its opacity actually changed
+	def refresh_cell(self, x, y):
+		old_opacity = self.opacity.item(y, x)
+		old_cost = self.cost.item(y, x)
+		self.derive_cell(x, y)
+		if self.opacity.item(y, x) != old_opacity:
+			self.fov_cache.invalidate((x, y))
+		if self.cost.item(y, x) != old_cost:
+			self.cost_version += 1
+			if self._hierarchy:
+				self._hierarchy.mark_dirty(x, y)
+
+	# engine selects one of fov.ENGINES, defaulting to the container's fov_engine.
+	# radius limits how far sight reaches, defaulting to the container's
+	# sight_radius
+	def visible_from(self, position, radius = None, engine = None):
+		engine = engine or self.fov_engine
+		radius = radius or self.sight_radius
+		key = (tuple(position), radius, engine)
+		result = self.fov_cache.get(key, self.opacity_version)
+		if result is None:
+			scanned = set()
+			result = fov.ENGINES[engine](self.opacity, key[0], radius, scanned)
+			self.fov_cache.put(key, self.opacity_version, result, scanned)
+		return result
 
 	def visibility_between(self, a, b):
 		return max(
@@ -126,13 +306,13 @@ class TileContainer:
  
 	def get_neighbors(self, x, y):
 		neighbors = []
+		cost = self.cost
 		for direction in util.MOORE_NEIGHBORHOOD:
 			neighbor_x = x + direction[0]
 			neighbor_y = y + direction[1]
-			if (neighbor_x, neighbor_y) not in self.contents:
+			if not (0 <= neighbor_x < self.width and 0 <= neighbor_y < self.height):
 				continue
-			cost = self.get_tile(neighbor_x, neighbor_y).traversal_cost()
-			if cost >= 0:
+			if cost.item(neighbor_y, neighbor_x) >= 0:
 				neighbors.append((neighbor_x, neighbor_y))
 		return neighbors
 
@@ -158,71 +338,158 @@ class TileContainer:
 
 		return came_from
 
-	def heuristic(self, start, goal = None):
+	# A* over the grid with a binary heap frontier. The search runs from goal
+	# back towards start so that following came_from out of start walks the
+	# path, and it stops as soon as start is settled. budget caps how many nodes
+	# may be expanded before giving up. Returns the list of positions to step
+	# through after start, ending with goal, or None if no path was found.
+	def heuristic(self, start, goal, budget = None):
 		start = tuple(start)
 		goal = tuple(goal)
+		if start == goal:
+			return []
 
-		frontier = [(start, 0)]
-		came_from = {}
-		came_from[start] = True
-		path_cost = { start: 0 }
+		cost = self.cost
+		buckets = self.entities.buckets if self.entities else {}
+		frontier = [(0, 0, goal)]
+		came_from = {goal: None}
+		path_cost = {goal: 0}
+		expanded = 0
 
 		while frontier:
-			current = frontier.pop(0)[0]
+			_, current_cost, current = heappop(frontier)
+			if current_cost > path_cost[current]:
+				continue # Stale entry, a cheaper route was found after it was pushed
 
-			if current == goal:
-				break
+			if current == start:
+				path = []
+				while current != goal:
+					current = came_from[current]
+					path.append(current)
+				return path
+
+			expanded += 1
+			if budget is not None and expanded > budget:
+				return None
 
 			for node in self.get_neighbors(*current):
-				node_cost = self.contents[node].traversal_cost()
+				node_cost = cost.item(node[1], node[0])
 				if node[0] != current[0] and node[1] != current[1]:
 					node_cost = int(node_cost * 1.4) # Increase costs for diagonal movement
-				node_cost += len(self.entities.buckets[node]) * 5 # Don't overcrowd
-				node_cost += path_cost[current]
+				if crowd := buckets.get(node):
+					node_cost += len(crowd) * 5 # Don't overcrowd
+				node_cost += current_cost
 
 				if node not in path_cost or node_cost < path_cost[node]:
 					path_cost[node] = node_cost
-					x_dist = abs(node[0] - goal[0])
-					y_dist = abs(node[1] - goal[1])
+					x_dist = abs(node[0] - start[0])
+					y_dist = abs(node[1] - start[1])
 					heuristic_dist = int((x_dist + y_dist - (min(x_dist, y_dist) * 0.6)) * 10)
-					priority = heuristic_dist + node_cost
-					x = 0
-					for i in range(0, len(frontier)):
-						x = i
-						if frontier[i][1] > priority:
-							break
-						x += 1
-					frontier.insert(x, (node, priority))
+					heappush(frontier, (heuristic_dist + node_cost, node_cost, node))
 					came_from[node] = current
 
-		return came_from
+		return None
+
+	def next_step_towards(self, start, goal, budget = None):
+		if (field := self.shared_flow_field(goal, start)) and field.reaches(start):
+			return field.step_from(start)
+		path = self.find_path(start, goal, budget)
+		return path[0] if path else None
+
+	# Picks between a flat search and the cluster hierarchy. Short trips always
+	# use the flat search since they never leave the neighbourhood anyway
+	def find_path(self, start, goal, budget = None):
+		if self.width * self.height >= self.HIERARCHY_THRESHOLD and \
+			util.manhattan_dist(start, goal) > self.CLUSTER_SIZE:
+			return self.hierarchy.find_path(start, goal)
+		return self.heuristic(start, goal, budget)
 
-	def next_step_towards(self, start, goal):
-		paths = self.heuristic(goal, start)
-		return paths[start]
+	@property
+	def hierarchy(self):
+		if self._hierarchy is None:
+			self._hierarchy = ClusterGraph(self, self.CLUSTER_SIZE)
+		return self._hierarchy
+
+	# Flow field towards goals, which may be a single position or a collection
+	# of them (e.g. every member of a faction), reaching FLOW_FIELD_RADIUS out
+	# from them. Fields are shared by everyone asking for the same goals and
+	# rebuilt once per tick or when the terrain changes, since crowding costs go
+	# stale as entities move.
+	def flow_field(self, goals):
+		key = frozenset((tuple(goals),)) if type(goals) == tuple else frozenset(map(tuple, goals))
+		self.expire_flow_fields()
+		field = self.flow_fields.get(key)
+		if field is None:
+			field = self.flow_fields[key] = FlowField(self, key, self.FLOW_FIELD_RADIUS)
+		return field
+
+	# Counts searches towards goal from within the field's reach, handing out
+	# the shared field once enough actors are chasing it this tick
+	def shared_flow_field(self, goal, start):
+		goal = tuple(goal)
+		if util.manhattan_dist(start, goal) > self.FLOW_FIELD_RADIUS:
+			return None
+		self.expire_flow_fields()
+		demand = self.flow_demand[goal] = self.flow_demand.get(goal, 0) + 1
+		if demand < self.flow_field_threshold:
+			return None
+		return self.flow_field(goal)
+
+	def expire_flow_fields(self):
+		stamp = (self.entities.time if self.entities else None, self.cost_version)
+		if stamp != self.flow_stamp:
+			self.flow_fields.clear()
+			self.flow_demand.clear()
+			self.flow_stamp = stamp
 
 	def map(self, func):
 		result = {}
-		for x in self.contents:
-			result[x] = func(self.contents, x)
+		for y in range(self.height):
+			for x in range(self.width):
+				result[(x, y)] = func(self, (x, y))
 		return result
 
 	# This is currently coupled too tightly to the definition of visual mapper
 	def map_visible(self, func, position, sees, seen):
 		result = {}
-		for x in self.contents:
-			if x in sees:
-				result[x] = func(self.contents, x)
-			elif x in seen:
-				result[x] = func(self.contents, x, 0.4)
+		for x in seen:
+			if self.in_bounds(*x) and x not in sees:
+				result[x] = func(self, x, 0.4)
+		for x in sees:
+			if self.in_bounds(*x):
+				result[x] = func(self, x)
 		return result
 
+	def in_bounds(self, x, y):
+		return 0 <= x < self.width and 0 <= y < self.height
+
 	def get_tile(self, x, y):
-		if (x, y) in self.contents:
-			return self.contents[(x, y)]
+		if 0 <= x < self.width and 0 <= y < self.height:
+			return TileView(self, x, y)
 		else:
 			return self.voidtile
 
+	def iter_tiles(self):
+		for y in range(self.height):
+			for x in range(self.width):
+				yield TileView(self, x, y)
+
+	def traversal_cost(self, x, y):
+		if 0 <= x < self.width and 0 <= y < self.height:
+			return self.cost.item(y, x)
+		return -1
+
+	def add_feature(self, x, y, feature):
+		features = self.features[y, x]
+		if features is None:
+			features = self.features[y, x] = []
+		features.append(feature)
+		features.sort(key = lambda x: x.z_index)
+		self.refresh_cell(x, y)
+
 	def set_tile(self, x, y, tile):
-		self.contents[(x, y)] = tile.copy()
-		self.construct_opacity_grid()
\ No newline at end of file
+		self.wall[y, x] = self.material_id(tile.wall_material)
+		self.floor[y, x] = self.material_id(tile.floor_material)
+		self.ceiling[y, x] = self.material_id(tile.ceiling_material)
+		self.features[y, x] = list(tile.features) or None
+		self.refresh_cell(x, y)
\ No newline at end of file
@@ -34,14 +34,14 @@ smooth_glyphs = {
 }
 
 def visual_map_func(tiles, position, brightness = 1.0):
-	tile = tiles[position]
+	tile = tiles.get_tile(*position)
 	result = None
 	if tile.wall_material.state == State.SOLID:
 		if tile.wall_material.smooth:
 			neighbors = []
 			for direction in NEUMANN_NEIGHBORHOOD:
-				x = tup_add(position, direction)
-				if x in tiles and (tiles[x].wall_material.smooth or tiles[x].contains_flag('wall_connect')):
+				neighbor = tiles.get_tile(*tup_add(position, direction))
+				if not neighbor.is_void() and (neighbor.wall_material.smooth or neighbor.contains_flag('wall_connect')):
 					neighbors.append(True)
 				else:
 					neighbors.append(False)
@@ -61,11 +61,4 @@ def visual_map_func(tiles, position, brightness = 1.0):
 			result.character = feature.symbol.character
 	result.bg = color_mul(result.bg, brightness)
 	result.fg = color_mul(result.fg, brightness)
-	return result
-
-def opacity(tiles, position):
-	tile = tiles[position]
-	result = tile.wall_material.opacity
-	for feature in tile.features:
-		result = max(result, 1 - feature.visibility)
 	return result
\ No newline at end of file